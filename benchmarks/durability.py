@@ -0,0 +1,38 @@
+# -*- coding:utf8 -*-
+"""
+Measures what each FilesystemHandler durability level costs per commit.
+
+    python benchmarks/durability.py [files per commit] [bytes per file]
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from storagealchemy.handler import FilesystemHandler, DURABILITY_LEVELS
+
+
+def run(durability, files, size):#{{{
+    path = tempfile.mkdtemp(prefix='storagealchemy-bench-')
+    try:
+        handler = FilesystemHandler(path, os.getuid(), os.getgid(), durability=durability)
+        data = 'x' * size
+        start = time.time()
+        for i in range(files):
+            handler.write('%02x/%s' % (i % 256, i), data)
+        handler.flush()
+        return time.time() - start
+    finally:
+        shutil.rmtree(path)
+    #}}}
+
+
+if __name__ == '__main__':
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    for durability in DURABILITY_LEVELS:
+        elapsed = run(durability, files, size)
+        print('%-10s %6d files  %8.3fs  %8.3fms/file' % (durability, files, elapsed, elapsed * 1000 / files))
@@ -1,6 +1,6 @@
 # -*- coding:utf-8 -*-
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='StorageAlchemy',
@@ -13,11 +13,17 @@ setup(
     license='BSD-3',
 
     packages=['storagealchemy'],
+    scripts=['scripts/storagealchemy-orphans'],
 
+    python_requires='>=3.7',
     install_requires=\
         [ 'sqlalchemy'
         , 'sqlahelper'
+        , 'transaction'
         ],
+    extras_require=\
+        { 'encrypt': ['cryptography']
+        },
 
     classifiers=[
        'Development Status :: 5 - Production/Stable',
@@ -25,9 +31,14 @@ setup(
        'License :: OSI Approved :: BSD License',
        'Natural Language :: English',
        'Operating System :: OS Independent',
-       'Programming Language :: Python :: 2.5',
-       'Programming Language :: Python :: 2.6',
-       'Programming Language :: Python :: 2.7',
+       'Programming Language :: Python :: 3',
+       'Programming Language :: Python :: 3 :: Only',
+       'Programming Language :: Python :: 3.7',
+       'Programming Language :: Python :: 3.8',
+       'Programming Language :: Python :: 3.9',
+       'Programming Language :: Python :: 3.10',
+       'Programming Language :: Python :: 3.11',
+       'Programming Language :: Python :: 3.12',
        'Topic :: Software Development :: Libraries :: Python Modules',
    ],
 )
@@ -1,13 +1,20 @@
 # -*- coding:utf8 -*-
 
 import logging
+import os
+import queue
+import threading
+import time
+import uuid
 import sqlalchemy as sa
 
 import sqlahelper
 import transaction
 
-from .exception import StorageError, NoSuchFile
+from .exception import StorageError, NoSuchFile, VersionConflict
+from .journal import Journal
 from . import handler
+from .handler import as_buffer, is_stream, iter_chunks
 
 Base = sqlahelper.get_base()
 Session = sqlahelper.get_session()
@@ -23,56 +30,286 @@ class Storage():
     def __init__(self):#{{{
         self._handlers = dict()
         self._tasks = dict()
+        self._journal = None
+        self._queues = list()
+        self._inflight = dict()
+        self._inflight_lock = threading.Lock()
+        self._inflight_landed = threading.Condition(self._inflight_lock)
+        self._journal_lock = threading.Lock()
+        self._held_locks = list()
 
         def add_hooks(*args, **kwargs):
             sa.event.listen(Session(), "after_soft_rollback", self._after_rollback_callback())
             sa.event.listen(Session(), "after_soft_rollback", add_hooks)
+            transaction.get().addBeforeCommitHook( self._before_commit_callback() )
             transaction.get().addAfterCommitHook( self._after_commit_callback() )
             transaction.get().addAfterCommitHook( add_hooks )
 
         add_hooks()#}}}
 
 
-    def add_handler(self, scheme, handler, read=True, write=True):#{{{
+    def add_handler(self, scheme, handler, read=True, write=True, pipeline=None):#{{{
+        """Registers handler for uris starting with scheme://.
+
+        A :class:`storagealchemy.transform.Pipeline` given as `pipeline`
+        encodes payloads before they are written and decodes them when
+        read. :meth:`stat` reads the decoded size from the trailer the
+        pipeline appends. Reading a range decodes the object as a stream
+        if every stage of the pipeline can, so only the range is kept in
+        memory, otherwise the whole object is decoded.
+
+        """
         self._handlers[scheme] = dict\
             ( handler = handler
             , read = read
             , write = write
+            , pipeline = pipeline
             )#}}}
 
 
-    def read(self, uri):
+    def enable_write_behind(self, journal_path, workers=4, batch_size=64, queue_size=1024):
+        #{{{
+        """Makes commits return as soon as their operations are journaled.
+
+        Committed writes and deletes are appended to a fsynced journal at
+        `journal_path` and applied by `workers` background threads. Until an
+        operation has landed, :meth:`read` and :meth:`list` serve it from
+        the journal, no payload is kept in memory. Every worker flushes the
+        handlers and marks its operations as done in the journal after at
+        most `batch_size` operations. Once `queue_size` operations are
+        waiting for a worker, commits block until it caught up.
+
+        An operation that fails is retried until it landed, the operations
+        queued behind it wait. Operations left in the journal by a previous
+        process are replayed right away, so call this after all handlers
+        were added. If one of them fails, it and the later ones on its uri
+        are left to the workers.
+
+        """
+        if self._journal is not None:
+            raise StorageError('write-behind is already enabled')
+        self._journal = journal = Journal(journal_path)
+        self._batch_size = batch_size
+        for i in range(workers):
+            tasks = queue.Queue(maxsize=queue_size)
+            worker = threading.Thread(target=self._write_behind_worker, args=(tasks,))
+            worker.daemon = True
+            worker.start()
+            self._queues.append(tasks)
+
+        replayed = list()
+        retried = list()
+        failed = set()
+        for seq, uri, action in journal.pending():
+            if uri not in failed:
+                try:
+                    self._apply(uri, action, journal.payload(seq))
+                    replayed.append(seq)
+                    continue
+                except Exception:
+                    log.exception('storage: replaying %(action)s of %(uri)s failed' % dict(action=action, uri=uri))
+                    failed.add(uri)
+            retried.append((seq, uri, action))
+        with self._journal_lock:
+            self._queue_operations(retried)
+        # the journal may only forget what is on disk
+        self._flush_handlers()
+        journal.done(replayed)
+        if replayed:
+            log.info('storage: replayed %(count)s journaled operations' % dict(count=len(replayed)))
+        #}}}
+
+
+    def flush(self):
+        #{{{
+        """Blocks until all write-behind operations have been applied.
+
+        """
+        for tasks in self._queues:
+            tasks.join()
+        #}}}
+
+
+    def read(self, uri, offset=0, length=None, with_version=False):
         #{{{
         """Returns storage contents for uri.
 
+        Pass `offset` and `length` to read only a range of the contents,
+        handlers which support it will not load the rest.
+
+        With `with_version` a tuple (data, version) is returned, version
+        can be passed to :meth:`write` as `if_match`. It is None for data
+        that has not been committed yet.
+
         """
+        version = None
+        action, data = self._get_pending(uri)
+        if action == 'copy':
+            # a pending copy reads the committed source
+            uri = data
+        elif action is not None:
+            if data is not None:
+                # a copy, the caller may still change its buffer
+                end = None if length is None else offset + length
+                data = as_buffer(data)[offset:end].tobytes()
+            return (data, version) if with_version else data
+        inflight, seq = self._get_inflight(uri)
+        if inflight == 'delete':
+            return (None, version) if with_version else None
+        if inflight == 'write':
+            data = self._journal.read(seq, offset, length)
+            if data is not None:
+                return (data, version) if with_version else data
+            # it landed in the meantime
         try:
-            return self._tasks[uri]['write']['data']
-        except KeyError:
-            try:
-                storage, path = self._get_storage(uri, 'r')
-                return storage.read(path)
-            except NoSuchFile:
+            storage, path = self._get_storage(uri, 'r')
+            pipeline = self._get_pipeline(uri, 'r')
+            if with_version and action is None:
+                # taken before reading, a concurrent change makes the
+                # token stale rather than the data
+                version = storage.version(path)
+            if pipeline is not None and (offset or length is not None):
+                data = pipeline.decode_range(iter_chunks(storage, path), offset, length)
+            elif pipeline is not None:
+                data = pipeline.decode(storage.read(path))
+            elif offset or length is not None:
+                data = storage.read(path, offset=offset, length=length)
+            else:
+                data = storage.read(path)
+        except NoSuchFile:
+            data = version = None
+        return (data, version) if with_version else data
+        #}}}
+
+
+    def stat(self, uri):
+        #{{{
+        """Returns a dict with `size` and `mtime` of uri, or None.
+
+        `size` is the size :meth:`read` returns, before any pipeline
+        encoded it. `mtime` is None for data that has not been committed
+        yet.
+
+        """
+        action, data = self._get_pending(uri)
+        if action == 'copy':
+            uri = data
+        elif action is not None:
+            if data is None:
                 return None
+            return dict(size=len(as_buffer(data)), mtime=None)
+        inflight, seq = self._get_inflight(uri)
+        if inflight == 'delete':
+            return None
+        if inflight == 'write':
+            size = self._journal.size(seq)
+            if size is not None:
+                return dict(size=size, mtime=None)
+        try:
+            storage, path = self._get_storage(uri, 'r')
+            stat = storage.stat(path)
+            pipeline = self._get_pipeline(uri, 'r')
+            if pipeline is not None:
+                # the handler only knows the encoded size
+                trailer = storage.read(path, offset=max(stat['size'] - pipeline.trailer_size, 0), length=pipeline.trailer_size)
+                stat = dict(stat, size=pipeline.decoded_size(trailer))
+            return stat
+        except NoSuchFile:
+            return None
         #}}}
 
 
-    def write(self, uri, data):
+    def exists(self, uri):
+        #{{{
+        """Returns whether uri exists, taking pending changes into account.
+
+        """
+        action, data = self._get_pending(uri)
+        if action == 'copy':
+            uri = data
+        elif action is not None:
+            return data is not None
+        inflight, seq = self._get_inflight(uri)
+        if inflight is not None:
+            return inflight == 'write'
+        storage, path = self._get_storage(uri, 'r')
+        return storage.has(path)
+        #}}}
+
+
+    def copy(self, src, dst):
+        #{{{
+        """Copies src to dst on commit.
+
+        Within one handler this is a reflink or hard link where possible,
+        otherwise the data is streamed from one handler into the other.
+        Raises :class:`NoSuchFile` if src does not exist.
+
+        """
+        self._copy_on_commit(src, dst, False)
+        #}}}
+
+
+    def move(self, src, dst):
+        #{{{
+        """Moves src to dst on commit, a rename within one handler.
+
+        """
+        if src == dst:
+            return
+        self._copy_on_commit(src, dst, True)
+        self._delete_on_commit(src)
+        #}}}
+
+
+    def size(self, uri):
+        #{{{
+        """Returns the size of uri in bytes, or None if it does not exist.
+
+        """
+        stat = self.stat(uri)
+        if stat is None:
+            return None
+        return stat['size']
+        #}}}
+
+
+    def write(self, uri, data, if_match=None):
         #{{{
         """Writes storage contents for uri.
 
+        `data` can be any buffer-protocol object, it is kept by reference
+        until the commit writes it, so do not modify it in the meantime.
+        Streams are not accepted, pending data has to be readable any
+        number of times.
+
+        With `if_match` the write only happens if uri still has the version
+        returned by :meth:`read`, otherwise committing the transaction
+        raises :class:`VersionConflict`. Right before the commit uri is
+        locked in its handler and the version checked, the lock is held
+        until the write landed. So of two conditional writes based on the
+        same version only one succeeds. Unconditional writes do not take
+        the lock, and for handlers without `lock_paths` the check is only
+        best-effort: a write can slip in between the check and the commit.
+
         """
+        if is_stream(data):
+            raise StorageError('cannot write a stream to %s, pass a buffer' % uri)
+        self._expect_version(uri, if_match)
         if data is None:
             self._delete_on_commit(uri)
         else:
             self._write_on_commit(uri, data)
         #}}}
 
-    def delete(self, uri):
+    def delete(self, uri, if_match=None):
         #{{{
         """Deletes an uri.
 
+        Takes `if_match` just like :meth:`write`.
+
         """
+        self._expect_version(uri, if_match)
         self._delete_on_commit(uri)
         #}}}
 
@@ -86,13 +323,17 @@ class Storage():
         for file in storage.list(path):
             result.add(file)
 
-        for uri in self._tasks:
+        with self._inflight_lock:
+            changes = [(uri, action == 'delete') for uri, (seq, action) in self._inflight.items()]
+        changes.extend((uri, 'delete' in self._tasks[uri]) for uri in self._tasks)
+
+        for uri, deleted in changes:
             if uri.startswith(uri_path):
                 _uri = uri.replace(uri_path,'')
                 if _uri.startswith('/'):
                     _uri = uri[1:]
                 if len(_uri.split('/')) == 1:
-                    if 'delete' not in self._tasks[uri]:
+                    if not deleted:
                         result.add(_uri)
                     elif _uri in result:
                         result.remove(_uri)
@@ -100,57 +341,440 @@ class Storage():
 
 
     def _write_on_commit(self, uri, data):#{{{
-        def write_later():
-            storage, path = self._get_storage(uri, 'w')
-            storage.write(path, data)
+        def write_later(encoded):
+            self._apply(uri, 'write', encoded, encoded=True)
         task = dict\
             ( callback = write_later
             , data = data
             )
         self._add_task(uri, 'write', task)
         self._drop_tasks(uri, 'delete')
+        self._drop_tasks(uri, 'copy')
         #}}}
 
 
     def _delete_on_commit(self, uri):#{{{
         def delete_later():
-            storage, path = self._get_storage(uri, 'w')
+            self._apply(uri, 'delete')
+        task = dict(callback=delete_later)
+        self._add_task(uri, 'delete', task)
+        self._drop_tasks(uri, 'write')
+        self._drop_tasks(uri, 'copy')
+        #}}}
+
+
+    def _copy_on_commit(self, src, dst, move):#{{{
+        if src == dst:
+            return
+        action, data = self._get_pending(src)
+        if action == 'copy':
+            # copy from where src is going to be copied from, src itself
+            # only is moved away if it was going to be moved as well
+            move = move and self._tasks[src]['copy']['move']
+            src = data
+        elif action is not None:
+            if data is None:
+                raise NoSuchFile(src)
+            # src is not committed yet, take its pending data along
+            self._write_on_commit(dst, data)
+            return
+        elif not self.exists(src):
+            raise NoSuchFile(src)
+
+        task = dict\
+            ( source = src
+            , move = move
+            )
+        self._add_task(dst, 'copy', task)
+        self._drop_tasks(dst, 'write')
+        self._drop_tasks(dst, 'delete')
+        #}}}
+
+
+
+    def _expect_version(self, uri, version):#{{{
+        if version is None:
+            return
+        expected = self._tasks.get(uri, dict()).get('if_match')
+        if expected is not None and expected != version:
+            # both refer to the committed version, one of them is stale
+            raise VersionConflict(uri)
+        if uri not in self._tasks:
+            self._tasks[uri] = dict()
+        self._tasks[uri]['if_match'] = version
+        #}}}
+
+
+    def _apply(self, uri, action, data=None, encoded=False):#{{{
+        storage, path = self._get_storage(uri, 'w')
+        if action == 'write':
+            if not encoded:
+                data = self._encode([(uri, data)])[0]
+            storage.write(path, data)
+        else:
             try:
                 storage.delete(path)
             except NoSuchFile:
                 pass
-        task = dict(callback=delete_later)
-        self._add_task(uri, 'delete', task)
-        self._drop_tasks(uri, 'write')
         #}}}
 
 
+    def _before_commit_callback(self):
+        def _before_commit():#{{{
+            conditions = [(uri, self._tasks[uri]['if_match']) for uri in self._tasks if 'if_match' in self._tasks[uri]]
+            # left over if a later before-commit hook failed the last commit
+            self._release_locks()
+            if not conditions:
+                return
+            # committed data still in flight is not versioned yet
+            self._wait_for([uri for uri, expected in conditions])
+            # released by _after_commit once the writes landed
+            self._held_locks = self._lock_paths([uri for uri, expected in conditions])
+            for uri, expected in conditions:
+                storage, path = self._get_storage(uri, 'w')
+                try:
+                    version = storage.version(path)
+                except NoSuchFile:
+                    version = None
+                if version != expected:
+                    log.debug('storage: version conflict on %(uri)s' % dict(uri=uri))
+                    self._release_locks()
+                    raise VersionConflict(uri)
+        return _before_commit
+        #}}}
+
+
+    def _lock_paths(self, uris):#{{{
+        """Locks uris in their handlers, handler by handler in the order
+        of their schemes. Returns a list of release functions.
+
+        """
+        groups = list()
+        for uri in sorted(uris, key=lambda uri: (self._get_scheme(uri, 'w'), uri)):
+            storage, path = self._get_storage(uri, 'w')
+            for handler, paths in groups:
+                if handler is storage:
+                    paths.append(path)
+                    break
+            else:
+                groups.append((storage, [path]))
+        releases = list()
+        try:
+            for handler, paths in groups:
+                if hasattr(handler, 'lock_paths'):
+                    releases.append(handler.lock_paths(paths))
+        except Exception:
+            for release in reversed(releases):
+                release()
+            raise
+        return releases
+        #}}}
+
+
+    def _release_locks(self):
+        releases, self._held_locks = self._held_locks, list()
+        for release in reversed(releases):
+            release()
+
 
     def _after_commit_callback(self):
         def _after_commit(status):#{{{
-            # perform write/delete action
-            drop_tasks = list()
-            for uri in self._tasks:
-                tasks = self._tasks[uri]
-                if 'delete' in tasks:
-                    tasks['delete']['callback']()
-                elif 'write' in tasks:
-                    tasks['write']['callback']()
-                drop_tasks.append(uri)
-            for uri in drop_tasks:
-                self._drop_tasks(uri)
+            try:
+                self._apply_tasks()
+            finally:
+                self._release_locks()
         return _after_commit
         #}}}
 
 
+    def _apply_tasks(self):#{{{
+        """Performs the copies, writes and deletes of a commit.
+
+        """
+        if self._journal is not None:
+            # copies read committed data and have to land after what is
+            # in flight for their sources and destinations
+            copies = [(uri, self._tasks[uri]['copy']['source']) for uri in self._tasks if 'copy' in self._tasks[uri]]
+            self._wait_for([uri for copy in copies for uri in copy])
+            conditioned = [uri for uri in self._tasks if 'if_match' in self._tasks[uri]]
+            self._perform_copies()
+            if copies:
+                # copies are not journaled, they have to be durable now
+                self._flush_handlers()
+            self._write_behind()
+            # the locks taken for conditional writes are held until they land
+            self._wait_for(conditioned)
+            return
+        self._perform_copies()
+        # encode all payloads of the commit at once, in parallel
+        writes = [(uri, self._tasks[uri]['write']['data']) for uri in self._tasks if 'write' in self._tasks[uri]]
+        encoded = dict(zip([uri for uri, data in writes], self._encode(writes)))
+        # perform write/delete action
+        drop_tasks = list()
+        for uri in self._tasks:
+            tasks = self._tasks[uri]
+            if 'delete' in tasks:
+                tasks['delete']['callback']()
+            elif 'write' in tasks:
+                tasks['write']['callback'](encoded[uri])
+            drop_tasks.append(uri)
+        for uri in drop_tasks:
+            self._drop_tasks(uri)
+        self._flush_handlers()
+        #}}}
+
+
+    def _perform_copies(self):#{{{
+        """Performs all pending copies and moves.
+
+        Every copy is first placed at a temporary name, reading only
+        committed data, copies before moves. Then all of them are renamed
+        into place, writes and deletes come after that. This way copies
+        into a uri that is itself copied or moved elsewhere, even swaps,
+        work out. If anything fails, the copies not renamed into place yet
+        are removed and moved sources are renamed back.
+
+        """
+        copies = [(uri, self._tasks[uri]['copy']) for uri in self._tasks if 'copy' in self._tasks[uri]]
+        copies.sort(key=lambda copy: copy[1]['move'])
+        staged = list()
+        try:
+            for uri, task in copies:
+                try:
+                    staged.append(self._stage_copy(task['source'], uri, task['move']))
+                except NoSuchFile:
+                    log.warning('storage: source %(source)s of %(uri)s vanished before commit' % dict(source=task['source'], uri=uri))
+            while staged:
+                storage, temp_path, path, moved_from = staged[0]
+                if temp_path is not None:
+                    storage.move(temp_path, path)
+                staged.pop(0)
+        except Exception:
+            self._unstage_copies(staged)
+            raise
+        #}}}
+
+
+    def _unstage_copies(self, staged):#{{{
+        for storage, temp_path, path, moved_from in reversed(staged):
+            if temp_path is None:
+                continue
+            try:
+                if moved_from is None:
+                    storage.delete(temp_path)
+                elif storage.has(moved_from):
+                    # something else was renamed into place there already
+                    raise StorageError('%s exists' % moved_from)
+                else:
+                    storage.move(temp_path, moved_from)
+            except Exception:
+                log.exception('storage: could not undo staged copy of %(path)s at %(temp_path)s' % dict(path=path, temp_path=temp_path))
+        #}}}
+
+
+    def _stage_copy(self, src, dst, move):#{{{
+        """Copies src to a temporary name next to dst.
+
+        Returns (handler, temporary path, destination path, moved path),
+        the temporary path is None if dst was written in place and the
+        moved path is the path src was renamed away from, if it was.
+
+        """
+        src_storage, src_path = self._get_storage(src, 'r')
+        dst_storage, dst_path = self._get_storage(dst, 'w')
+        src_pipeline = self._get_pipeline(src, 'r')
+        dst_pipeline = self._get_pipeline(dst, 'w')
+        if hasattr(dst_storage, 'move'):
+            directory, name = os.path.split(dst_path)
+            temp_path = os.path.join(directory, '.%s.%s.tmp' % (name, uuid.uuid4().hex))
+        else:
+            # nothing to rename with, write in place
+            temp_path = dst_path
+
+        if src_storage is dst_storage and move and temp_path != dst_path and src_pipeline is dst_pipeline:
+            dst_storage.move(src_path, temp_path)
+            return dst_storage, temp_path, dst_path, src_path
+
+        try:
+            if src_pipeline is not dst_pipeline:
+                # the stored bytes differ, the payload has to be transcoded
+                data = src_storage.read(src_path)
+                if src_pipeline is not None:
+                    data = src_pipeline.decode(data)
+                dst_storage.write(temp_path, self._encode([(dst, data)])[0])
+            elif src_storage is dst_storage and hasattr(dst_storage, 'copy'):
+                dst_storage.copy(src_path, temp_path)
+            else:
+                # the source is deleted by its own delete task when moving
+                dst_storage.write(temp_path, iter_chunks(src_storage, src_path))
+        except Exception:
+            if temp_path != dst_path:
+                try:
+                    dst_storage.delete(temp_path)
+                except Exception:
+                    # it may not even have been created
+                    pass
+            raise
+        if temp_path == dst_path:
+            return dst_storage, None, dst_path, None
+        return dst_storage, temp_path, dst_path, None
+        #}}}
+
+
+    def _write_behind(self):#{{{
+        operations = list()
+        for uri in self._tasks:
+            tasks = self._tasks[uri]
+            if 'delete' in tasks:
+                operations.append((uri, 'delete', None))
+            elif 'write' in tasks:
+                operations.append((uri, 'write', tasks['write']['data']))
+        self._tasks = dict()
+        if not operations:
+            return
+
+        # concurrent commits queue their operations in journal order
+        with self._journal_lock:
+            seqs = self._journal.append(operations)
+            # from here on payloads are read back from the journal
+            self._queue_operations([(seq, uri, action) for seq, (uri, action, data) in zip(seqs, operations)])
+        #}}}
+
+
+    def _queue_operations(self, operations):#{{{
+        """Hands journaled (seq, uri, action) operations to the workers.
+
+        """
+        with self._inflight_lock:
+            for seq, uri, action in operations:
+                self._inflight[uri] = (seq, action)
+        for seq, uri, action in operations:
+            # operations on the same uri always go to the same worker, so
+            # they are applied in commit order
+            self._queues[hash(uri) % len(self._queues)].put((seq, uri, action))
+        #}}}
+
+
+    def _write_behind_worker(self, tasks):#{{{
+        applied = list()
+        while True:
+            seq, uri, action = tasks.get()
+            delay = 0.1
+            while True:
+                try:
+                    self._apply(uri, action, self._journal.payload(seq))
+                    break
+                except Exception:
+                    # it stays in flight, a later operation on uri must not
+                    # land before it
+                    log.exception('storage: write-behind %(action)s of %(uri)s failed, retrying in %(delay)s seconds' % dict(action=action, uri=uri, delay=delay))
+                    time.sleep(delay)
+                    delay = min(delay * 2, 30)
+            applied.append(seq)
+            with self._inflight_landed:
+                if self._inflight.get(uri, (None,))[0] == seq:
+                    del(self._inflight[uri])
+                    self._inflight_landed.notify_all()
+            if tasks.empty() or len(applied) >= self._batch_size:
+                try:
+                    self._flush_handlers()
+                    self._journal.done(applied)
+                    applied = list()
+                except Exception:
+                    # tried again with the next batch
+                    log.exception('storage: write-behind flush failed')
+            tasks.task_done()
+        #}}}
+
+
+    def _wait_for(self, uris):#{{{
+        """Blocks until no write-behind operation on uris is in flight.
+
+        """
+        uris = set(uris)
+        with self._inflight_landed:
+            while uris.intersection(self._inflight):
+                self._inflight_landed.wait()
+        #}}}
+
+
+    def _flush_handlers(self):#{{{
+        handlers = list()
+        for scheme in self._handlers:
+            handler = self._handlers[scheme]['handler']
+            if handler not in handlers and hasattr(handler, 'flush'):
+                handlers.append(handler)
+        for handler in handlers:
+            handler.flush()
+        #}}}
+
+
+    def _get_pending(self, uri):#{{{
+        """Returns (action, data) of the latest uncommitted change to uri,
+        data is None for deletes and the source uri for copies. Returns
+        (None, None) if there is none.
+
+        """
+        tasks = self._tasks.get(uri, dict())
+        if 'delete' in tasks:
+            return 'delete', None
+        if 'write' in tasks:
+            return 'write', tasks['write']['data']
+        if 'copy' in tasks:
+            return 'copy', tasks['copy']['source']
+        return None, None
+        #}}}
+
+
+    def _get_inflight(self, uri):#{{{
+        """Returns (action, seq) of the write-behind operation on uri that
+        has not landed yet, or (None, None).
+
+        """
+        with self._inflight_lock:
+            seq, action = self._inflight.get(uri, (None, None))
+        return action, seq
+        #}}}
+
+
     def _after_rollback_callback(self):
         def _after_rollback(session, previous_transaction):#{{{
             self._tasks = dict()
+            self._release_locks()
         return _after_rollback
         #}}}
 
 
+    def _encode(self, items):#{{{
+        """Returns the payloads of a list of (uri, data) as they are to be
+        written, every pipeline encodes all of its payloads in one go.
+
+        """
+        result = [data for uri, data in items]
+        groups = dict()
+        for n, (uri, data) in enumerate(items):
+            pipeline = self._get_pipeline(uri, 'w')
+            if pipeline is not None:
+                groups.setdefault(pipeline, list()).append(n)
+        for pipeline in groups:
+            payloads = pipeline.encode_many([result[n] for n in groups[pipeline]])
+            for n, data in zip(groups[pipeline], payloads):
+                result[n] = data
+        return result
+        #}}}
+
+
+    def _get_pipeline(self, uri, mode):
+        return self._handlers[self._get_scheme(uri, mode)]['pipeline']
+
+
     def _get_storage(self, uri, mode):#{{{
+        uri_scheme = self._get_scheme(uri, mode)
+        return self._handlers[uri_scheme]['handler'], uri.replace("%s://" % uri_scheme ,'')
+        #}}}
+
+
+    def _get_scheme(self, uri, mode):#{{{
         uri_scheme = None
         for scheme in self._handlers:
             if uri.startswith("%s://" % scheme):
@@ -169,7 +793,7 @@ class Storage():
 
         if uri_scheme is not None \
         and uri_scheme in self._handlers:
-            return self._handlers[uri_scheme]['handler'], uri.replace("%s://" % uri_scheme ,'')
+            return uri_scheme
 
         raise StorageError('could not find storage for uri %s' % uri)
         #}}}
@@ -15,3 +15,9 @@ class WaitForLockTimout(StorageError):
 
 class WaitForUnlockTimout(StorageError):
     pass
+
+class VersionConflict(StorageError):
+    pass
+
+class CorruptData(StorageError):
+    pass
@@ -1,35 +1,158 @@
 # -*- coding:utf8 -*-
 
+import errno
 import logging
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
 import datetime
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from .exception import StorageError, NoSuchFile
 
 log = logging.getLogger(__name__)
 
 
+DURABILITY_LEVELS = ('none', 'commit', 'per-file')
+
+# most kernels refuse writev calls with more buffers than this
+IOV_MAX = 1024
+
+# ioctl cloning a file's extents on btrfs, xfs and friends (linux/fs.h)
+FICLONE = 0x40049409
+
+# chunk size used when streaming data from one handler into another
+CHUNK_SIZE = 1024 * 1024
+
+# number of lock files the paths of conditional writes are hashed onto
+LOCK_STRIPES = 1024
+
+
+
+def as_buffer(data):#{{{
+    """Returns a flat byte view of data without copying it.
+
+    Accepts any object supporting the buffer protocol. Text is the only
+    thing that gets copied, it is encoded as utf-8.
+
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    view = memoryview(data)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast('B')
+    return view
+    #}}}
+
+
+def buffer_size(data):
+    """Returns the size of data in bytes, None for streams.
+
+    """
+    if is_stream(data):
+        return None
+    if isinstance(data, (list, tuple)):
+        return sum(buffer_size(x) for x in data)
+    return len(as_buffer(data))
+
+
+def is_stream(data):
+    return hasattr(data, '__next__')
+
+
+def iter_chunks(handler, path, chunk_size=CHUNK_SIZE):#{{{
+    """Returns an iterator over the contents of path in `handler`.
+
+    The first chunk is read right away, so a missing file raises
+    :class:`NoSuchFile` here rather than halfway through a write.
+
+    """
+    first = handler.read(path, offset=0, length=chunk_size)
+    def chunks():
+        chunk, offset = first, 0
+        while chunk:
+            yield chunk
+            if len(chunk) < chunk_size:
+                break
+            offset += len(chunk)
+            chunk = handler.read(path, offset=offset, length=chunk_size)
+    return chunks()
+    #}}}
+
+
+
 
 class FilesystemHandler(object):
     """
     Stores files in local directory.
 
+    `durability` controls when written files are fsynced:
+
+    * ``none``: never, the kernel writes them back whenever it likes.
+    * ``commit``: all files and directories touched by a commit are fsynced
+      together by :meth:`flush`, in parallel on `fsync_workers` threads.
+    * ``per-file``: every file and its directory are fsynced right away.
+
     """
 
     storage_path = None
 
-    def __init__(self, storage_path, uid, gid, max_lock_time = 10):
+    def __init__(self, storage_path, uid, gid, max_lock_time = 10, durability = 'none', fsync_workers = 8):
+        if durability not in DURABILITY_LEVELS:
+            raise StorageError('unknown durability level %s' % durability)
         self.storage_path = os.path.realpath(storage_path)
         self.uid = uid
         self.gid = gid
         self.max_lock_time = max_lock_time  # max lock time in seconds
+        self.durability = durability
+        self.fsync_workers = fsync_workers
+        self._unsynced_files = set()
+        self._unsynced_dirs = set()
+        self._unsynced_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._fsync_pool = None
 
 
     def has(self, path):
+        if path.startswith('/'):
+            path = path[1:]
         return os.path.isfile(os.path.join(self.storage_path, path))
 
 
+    def stat(self, path):#{{{
+        if path.startswith('/'):
+            path = path[1:]
+        path = os.path.join(self.storage_path, path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise NoSuchFile(path)
+        return dict(size=st.st_size, mtime=st.st_mtime)#}}}
+
+
+    def version(self, path):#{{{
+        """Returns a token that changes whenever the file is replaced or
+        rewritten.
+
+        """
+        path = self._local_path(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise NoSuchFile(path)
+        return '%x-%x-%x' % (st.st_mtime_ns, st.st_size, st.st_ino)#}}}
+
+
     def list(self, path):
         real_path = os.path.join(self.storage_path, path)
         if os.path.isdir(real_path):
@@ -38,16 +161,46 @@ class FilesystemHandler(object):
                     yield x
 
 
-    def read(self, path, **kwargs):#{{{
+    def walk(self, path='', workers=8):#{{{
+        """Yields the paths of all files below path, in no particular order.
+
+        Directories are scanned with os.scandir on `workers` threads.
+        The files the library keeps itself are skipped: the ``.locks``
+        directory, a ``.journal`` and hidden ``.lock`` and ``.tmp`` files
+        like lock files and staged copies. Other hidden files are stored
+        files like any other and are yielded.
+
+        """
+        root = self._local_path(path)
+        if not os.path.isdir(root):
+            return
+        prefix = len(self.storage_path) + 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set([pool.submit(_scan_dir, root)])
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, directories = future.result()
+                    for directory in directories:
+                        pending.add(pool.submit(_scan_dir, directory))
+                    for file in files:
+                        yield file[prefix:]
+        #}}}
+
+
+    def read(self, path, offset=0, length=None, **kwargs):#{{{
         if path.startswith('/'):
             path = path[1:]
         path = os.path.join(self.storage_path, path)
 
+        if offset or length is not None:
+            return self._read_range(path, offset, length)
+
         if not os.path.isfile(path):
             raise NoSuchFile(path)
 
         try:
-            fp = open(path, 'r')
+            fp = open(path, 'rb')
             data = fp.read()
             fp.close()
         except IOError:
@@ -58,19 +211,63 @@ class FilesystemHandler(object):
         return data#}}}
 
 
+    def _read_range(self, path, offset, length):#{{{
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            raise NoSuchFile(path)
+        try:
+            if length is None:
+                length = max(os.fstat(fd).st_size - offset, 0)
+            chunks = list()
+            while length > 0:
+                # a single pread unless the kernel returns a short read
+                chunk = os.pread(fd, length, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                length -= len(chunk)
+        finally:
+            os.close(fd)
+        return b''.join(chunks)#}}}
+
+
     def write(self, path, data, **kwargs):#{{{
+        """Writes data to path.
+
+        `data` can be any buffer-protocol object (bytes, bytearray,
+        memoryview, numpy arrays, ...) or a list of them, which are written
+        straight from their memory with os.write/os.writev. Iterators of
+        buffers are written chunk by chunk.
+
+        """
         if not path.startswith('.') and not path.endswith('.lock'):
-            log.debug('storage.write: path=%(path)s, len(data) = %(len_data)s' % dict(path=path, len_data=len(data)))
+            log.debug('storage.write: path=%(path)s, len(data) = %(len_data)s' % dict(path=path, len_data=buffer_size(data)))
 
-        if path.startswith('/'):
-            path = path[1:]
-        path = os.path.join(self.storage_path, path)
-        if not os.path.isdir(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
-        fp = open(path, 'w')
-        fp.write(data)
-        fp.close()
+        path = self._local_path(path)
+        directories = self._makedirs(path)
+        try:
+            if os.stat(path).st_nlink > 1:
+                # do not write through a hard link made by copy()
+                os.remove(path)
+        except OSError:
+            pass
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            if is_stream(data):
+                for chunk in data:
+                    write_buffers(fd, [chunk])
+            else:
+                if not isinstance(data, (list, tuple)):
+                    data = [data]
+                write_buffers(fd, data)
+            if self.durability == 'per-file':
+                os.fsync(fd)
+        finally:
+            os.close(fd)
         os.chown(path, int(self.uid), int(self.gid))
+        self._sync_later([path], directories)
         return True#}}}
 
 
@@ -89,13 +286,151 @@ class FilesystemHandler(object):
 
         os.remove(path)
 
+        self._sync_later([], [self._remove_empty_dirs(path)])
+        return True#}}}
+
+
+    def copy(self, src, dst, **kwargs):#{{{
+        """Copies src to dst without moving the data through Python.
+
+        Tries a reflink first, then a hard link (writes break it up again),
+        and falls back to a plain copy across filesystems.
+
+        """
+        log.debug('filesystem.storage.copy: src=%(src)s, dst=%(dst)s' % dict(src=src, dst=dst))
+        src = self._local_path(src)
+        dst = self._local_path(dst)
+        if not os.path.isfile(src):
+            raise NoSuchFile(src)
+
+        directories = self._makedirs(dst)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            _reflink(src, dst)
+            linked = False
+        except (IOError, OSError):
+            try:
+                os.link(src, dst)
+                linked = True
+            except OSError:
+                shutil.copyfile(src, dst)
+                linked = False
+        if self.durability == 'per-file' and not linked:
+            # a hard link shares the synced inode of src, a copy does not
+            fsync_path(dst)
+        os.chown(dst, int(self.uid), int(self.gid))
+        self._sync_later([dst], directories)
+        return True#}}}
+
+
+    def move(self, src, dst, **kwargs):#{{{
+        log.debug('filesystem.storage.move: src=%(src)s, dst=%(dst)s' % dict(src=src, dst=dst))
+        src = self._local_path(src)
+        dst = self._local_path(dst)
+        if not os.path.isfile(src):
+            raise NoSuchFile(src)
+
+        directories = self._makedirs(dst)
+        os.replace(src, dst)
+        directories.append(self._remove_empty_dirs(src))
+        self._sync_later([], directories)
+        return True#}}}
+
+
+    def lock_paths(self, paths):#{{{
+        """Locks paths against other threads and processes locking them,
+        returns a function releasing the locks.
+
+        Paths are hashed onto `LOCK_STRIPES` files in the hidden ``.locks``
+        directory, which are flocked in order so that callers locking
+        several paths cannot deadlock.
+
+        """
+        if fcntl is None:
+            raise StorageError('locking paths needs fcntl')
+        directory = os.path.join(self.storage_path, '.locks')
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        stripes = set()
+        for path in paths:
+            stripe = zlib.crc32(self._local_path(path).encode('utf-8')) % LOCK_STRIPES
+            stripes.add(os.path.join(directory, '%04d' % stripe))
+        return _lock_all(_stripe_locks, sorted(stripes))
+        #}}}
+
+
+    def _local_path(self, path):#{{{
+        if path.startswith('/'):
+            path = path[1:]
+        return os.path.join(self.storage_path, path)
+        #}}}
+
+
+    def _makedirs(self, path):#{{{
+        """Creates the parent directories of path.
+
+        Returns the directories whose entries change, new directories
+        need their own entry in the parent synced.
+
+        """
+        directories = [os.path.dirname(path)]
+        if not os.path.isdir(directories[0]):
+            while not os.path.isdir(directories[-1]):
+                directories.append(os.path.dirname(directories[-1]))
+            os.makedirs(directories[0])
+        return directories
+        #}}}
+
+
+    def _remove_empty_dirs(self, path):#{{{
+        """Removes the directories left empty after removing path.
+
+        Returns the first directory that was kept.
+
+        """
         path = os.path.realpath(os.path.dirname(path))
         while not len(os.listdir(path)):
             if os.path.realpath(self.storage_path) == os.path.realpath(path):
                 break
             os.rmdir(path)
             path = os.path.realpath(os.path.join(path, os.path.pardir))
-        return True#}}}
+        return path
+        #}}}
+
+
+    def flush(self):#{{{
+        """Fsyncs everything written since the last flush.
+
+        Called by :class:`storagealchemy.Storage` once per commit. Files are
+        synced before their directories, so a directory entry never points
+        to a file whose contents did not make it to disk.
+
+        """
+        with self._flush_lock:
+            with self._unsynced_lock:
+                files, self._unsynced_files = self._unsynced_files, set()
+                directories, self._unsynced_dirs = self._unsynced_dirs, set()
+            if not files and not directories:
+                return
+            if self._fsync_pool is None:
+                self._fsync_pool = ThreadPoolExecutor(max_workers=self.fsync_workers)
+            # fsync releases the GIL, so the syncs overlap in the kernel
+            list(self._fsync_pool.map(fsync_path, files))
+            list(self._fsync_pool.map(fsync_path, directories))
+            log.debug('filesystem.storage.flush: files=%(files)s, directories=%(directories)s' % dict(files=len(files), directories=len(directories)))
+        #}}}
+
+
+    def _sync_later(self, files, directories):#{{{
+        if self.durability == 'per-file':
+            for directory in directories:
+                fsync_path(directory)
+        elif self.durability == 'commit':
+            with self._unsynced_lock:
+                self._unsynced_files.update(files)
+                self._unsynced_dirs.update(directories)
+        #}}}
 
 
 
@@ -112,7 +447,7 @@ class FilesystemHandler(object):
         lock_path = ".%s.lock" % path
         try:
             if not force:
-                lock_timestamp = self.read(lock_path)
+                lock_timestamp = self.read(lock_path).decode('utf-8')
                 if lock_timestamp != str(lock):
                     return
         except NoSuchFile:
@@ -145,6 +480,1063 @@ class FilesystemHandler(object):
 
 
 
+# names of the files and directories the library keeps next to the stored files
+_INTERNAL_NAMES = ('.locks', '.journal')
+
+
+def _is_internal(name):
+    # lock files are named .<name>.lock, staged copies .<name>.<uuid>.tmp
+    return name in _INTERNAL_NAMES or name.startswith('.') and name.endswith(('.lock', '.tmp'))
+
+
+def _scan_dir(path):#{{{
+    files = list()
+    directories = list()
+    for entry in os.scandir(path):
+        if _is_internal(entry.name):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            directories.append(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            files.append(entry.path)
+    return files, directories
+    #}}}
+
+
+class _LockTable(object):
+    """
+    Exclusive locks on keys for the threads of this process. A thread can
+    take a lock it holds once more, it is released after as many releases.
+
+    `take` is called with the key when a lock is first taken, `drop` with
+    what take returned when it is finally released.
+
+    """
+
+    def __init__(self, take=None, drop=None):
+        self._take = take
+        self._drop = drop
+        self._held = dict()
+        self._released = threading.Condition()
+
+
+    def acquire(self, key):#{{{
+        me = threading.current_thread()
+        with self._released:
+            while key in self._held and self._held[key][0] is not me:
+                self._released.wait()
+            if key in self._held:
+                self._held[key][1] += 1
+                return
+            self._held[key] = [me, 1, None]
+        try:
+            # may block on another process, other threads wait above
+            value = self._take(key) if self._take is not None else None
+        except Exception:
+            with self._released:
+                del(self._held[key])
+                self._released.notify_all()
+            raise
+        with self._released:
+            self._held[key][2] = value
+        #}}}
+
+
+    def release(self, key):#{{{
+        with self._released:
+            self._held[key][1] -= 1
+            if self._held[key][1]:
+                return
+            owner, count, value = self._held.pop(key)
+            if self._drop is not None:
+                self._drop(value)
+            self._released.notify_all()
+        #}}}
+
+
+
+def _lock_all(table, keys):#{{{
+    acquired = list()
+    try:
+        for key in keys:
+            table.acquire(key)
+            acquired.append(key)
+    except Exception:
+        for key in reversed(acquired):
+            table.release(key)
+        raise
+    def release():
+        for key in reversed(acquired):
+            table.release(key)
+    return release
+    #}}}
+
+
+def _flock(path):#{{{
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+    #}}}
+
+
+# lock files are shared by all FilesystemHandlers of the process, a
+# second flock on another descriptor of the same file would deadlock
+_stripe_locks = _LockTable(_flock, os.close)
+
+
+def _reflink(src, dst):#{{{
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except (IOError, OSError):
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    #}}}
+
+
+def write_buffers(fd, buffers):#{{{
+    views = [view for view in map(as_buffer, buffers) if len(view)]
+    while views:
+        if len(views) == 1:
+            written = os.write(fd, views[0])
+        else:
+            written = os.writev(fd, views[:IOV_MAX])
+        # drop what was written, partial writes continue mid-buffer
+        while written:
+            if written >= len(views[0]):
+                written -= len(views.pop(0))
+            else:
+                views[0] = views[0][written:]
+                written = 0
+    #}}}
+
+
+def fsync_path(path):#{{{
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        # deleted again before it was synced
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    #}}}
+
+
+
+
+
+
+class PackHandler(object):
+    """
+    Packs small objects into large append-only segment files.
+
+    Every object is appended to the active segment, an index maps its path
+    to (segment, offset, length). Deletes only remove the path from the
+    index, :meth:`compact` rewrites segments whose live data dropped below
+    `compact_ratio` and removes them.
+
+    The index is a sqlite database next to the segments, nothing of it is
+    held in memory, so a handler can hold billions of objects. Listing a
+    path only reads the entries below it, skipping subdirectories.
+
+    With durability ``commit`` :meth:`flush` fsyncs each touched segment
+    once and then commits the index changes of the commit, so the index
+    never points at data that is not on disk.
+
+    Only one PackHandler can use a directory at a time, it is locked with
+    flock until :meth:`close`. Another one, in this or any other process,
+    raises :class:`StorageError`.
+
+    """
+
+    storage_path = None
+
+    # paths fetched from the index at a time when listing
+    list_batch_size = 1000
+
+    def __init__(self, storage_path, segment_size = 64 * 1024 * 1024, durability = 'commit', compact_ratio = 0.5):#{{{
+        if durability not in DURABILITY_LEVELS:
+            raise StorageError('unknown durability level %s' % durability)
+        self.storage_path = os.path.realpath(storage_path)
+        self.segment_size = segment_size
+        self.durability = durability
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._read_fds = dict()
+        self._unsynced_segments = set()
+        self._in_transaction = False
+        self._new_segments = False
+        self._compactor = None
+        self._compact_lock = threading.Lock()
+        self._path_locks = _LockTable()
+
+        if not os.path.isdir(self.storage_path):
+            os.makedirs(self.storage_path)
+        self._lock_directory()
+        self._index_path = os.path.join(self.storage_path, 'index.db')
+        # its directory entry is synced along with new segments
+        self._new_segments = not os.path.exists(self._index_path)
+        self._db = self._connect()
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS objects'
+            ' ( path TEXT PRIMARY KEY'
+            ' , segment INTEGER NOT NULL'
+            ' , offset INTEGER NOT NULL'
+            ' , length INTEGER NOT NULL'
+            ' , mtime REAL NOT NULL'
+            ' ) WITHOUT ROWID')
+        self._db.execute('CREATE INDEX IF NOT EXISTS extents ON objects (segment, offset, length)')
+
+        segments = self._segments()
+        self._last_segment = segments[-1] if segments else 0
+        self._open_segment(segments[-1] if segments else self._next_segment())
+        #}}}
+
+
+    def has(self, path):
+        with self._lock:
+            return self._lookup(path) is not None
+
+
+    def stat(self, path):#{{{
+        with self._lock:
+            entry = self._lookup(path)
+        if entry is None:
+            raise NoSuchFile(path)
+        segment, offset, length, mtime = entry
+        return dict(size=length, mtime=mtime)#}}}
+
+
+    def version(self, path):#{{{
+        """Returns a token that changes whenever path is written again.
+
+        """
+        with self._lock:
+            entry = self._lookup(path)
+        if entry is None:
+            raise NoSuchFile(path)
+        segment, offset, length, mtime = entry
+        return '%x-%x-%x' % (segment, offset, length)#}}}
+
+
+    def list(self, path):#{{{
+        prefix = _pack_path(path)
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        start, inclusive = prefix, True
+        while True:
+            paths = self._range(start, inclusive, _prefix_end(prefix))
+            for x in paths:
+                name = x[len(prefix):]
+                if '/' in name:
+                    # continue right after the subdirectory
+                    start, inclusive = prefix + name[:name.index('/')] + '0', True
+                    break
+                yield name
+                start, inclusive = x, False
+            else:
+                if len(paths) < self.list_batch_size:
+                    return
+        #}}}
+
+
+    def walk(self, path='', **kwargs):#{{{
+        """Yields the paths of all objects below path, in no particular
+        order.
+
+        """
+        prefix = _pack_path(path)
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        start, inclusive = prefix, True
+        while True:
+            paths = self._range(start, inclusive, _prefix_end(prefix))
+            for x in paths:
+                yield x
+            if len(paths) < self.list_batch_size:
+                return
+            start, inclusive = paths[-1], False
+        #}}}
+
+
+    def read(self, path, offset=0, length=None, **kwargs):#{{{
+        with self._lock:
+            entry = self._lookup(path)
+            if entry is None:
+                raise NoSuchFile(path)
+            segment, start, size, mtime = entry
+            offset = min(offset, size)
+            if length is None or offset + length > size:
+                length = size - offset
+            return b''.join(_pread_chunks(self._read_fd(segment), start + offset, length))
+        #}}}
+
+
+    def write(self, path, data, **kwargs):#{{{
+        """Appends data to the active segment.
+
+        Takes the same buffers, lists of buffers and streams as
+        :meth:`FilesystemHandler.write`.
+
+        """
+        path = _pack_path(path)
+        with self._lock:
+            segment, start, length = self._append_object(data)
+            log.debug('pack.storage.write: path=%(path)s, segment=%(segment)s, len(data) = %(len_data)s' % dict(path=path, segment=segment, len_data=length))
+            self._update([('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', (path, segment, start, length, time.time()))])
+        return True#}}}
+
+
+    def delete(self, path, **kwargs):#{{{
+        path = _pack_path(path)
+        with self._lock:
+            if self._lookup(path) is None:
+                raise NoSuchFile(path)
+            log.debug('pack.storage.delete: path=%(path)s' % dict(path=path))
+            self._update([('DELETE FROM objects WHERE path = ?', (path,))])
+        return True#}}}
+
+
+    def copy(self, src, dst, **kwargs):#{{{
+        """Points dst at the data of src, nothing is copied.
+
+        """
+        src = _pack_path(src)
+        dst = _pack_path(dst)
+        with self._lock:
+            entry = self._lookup(src)
+            if entry is None:
+                raise NoSuchFile(src)
+            self._update([('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', (dst,) + entry)])
+        return True#}}}
+
+
+    def move(self, src, dst, **kwargs):#{{{
+        src = _pack_path(src)
+        dst = _pack_path(dst)
+        with self._lock:
+            entry = self._lookup(src)
+            if entry is None:
+                raise NoSuchFile(src)
+            if src != dst:
+                self._update(
+                    [ ('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', (dst,) + entry)
+                    , ('DELETE FROM objects WHERE path = ?', (src,))
+                    ])
+        return True#}}}
+
+
+    def lock_paths(self, paths):#{{{
+        """Locks paths against other threads locking them, returns a
+        function releasing the locks.
+
+        The directory lock already keeps other processes out.
+
+        """
+        return _lock_all(self._path_locks, sorted(set(_pack_path(path) for path in paths)))
+        #}}}
+
+
+    def flush(self):#{{{
+        """Fsyncs the segments written since the last flush, then commits
+        their index changes.
+
+        """
+        with self._lock:
+            self._flush()
+        #}}}
+
+
+    def compact(self):#{{{
+        """Rewrites sealed segments with little live data and removes them.
+
+        Segments are compacted one after the other. The live data of each
+        is copied into new segments without holding the handler's lock,
+        reads and writes only wait while its index entries are switched
+        over. The index is scanned through a connection of its own, which
+        sees the last flushed state. Objects sharing data through
+        :meth:`copy` keep sharing it. Returns the number of segments
+        removed.
+
+        """
+        with self._compact_lock:
+            with self._lock:
+                self._flush()
+                sizes = dict()
+                for segment in self._segments():
+                    if segment != self._segment:
+                        sizes[segment] = os.path.getsize(self._segment_path(segment))
+
+            db = self._connect()
+            output = _SegmentWriter(self)
+            try:
+                live = dict(db.execute(
+                    'SELECT segment, SUM(length) FROM'
+                    ' (SELECT DISTINCT segment, offset, length FROM objects)'
+                    ' GROUP BY segment'))
+                victims = [segment for segment in sorted(sizes) if not sizes[segment] or live.get(segment, 0) < sizes[segment] * self.compact_ratio]
+                for segment in victims:
+                    # sealed segments do not change anymore, and every
+                    # entry pointing into them was flushed above
+                    extents = db.execute('SELECT DISTINCT offset, length FROM objects WHERE segment = ? ORDER BY offset', (segment,)).fetchall()
+                    moved = output.copy(segment, extents)
+                    with self._lock:
+                        # copies made meanwhile point at the old extents as well
+                        self._update([('UPDATE objects SET segment = ?, offset = ? WHERE segment = ? AND offset = ? AND length = ?', (new_segment, new_offset, segment, offset, length)) for (offset, length), (new_segment, new_offset) in moved])
+                        self._flush()
+                        fd = self._read_fds.pop(segment, None)
+                        if fd is not None:
+                            os.close(fd)
+                        os.remove(self._segment_path(segment))
+                        fsync_path(self.storage_path)
+            finally:
+                output.close()
+                db.close()
+            log.debug('pack.storage.compact: segments=%(segments)s' % dict(segments=victims))
+            return len(victims)
+        #}}}
+
+
+    def close(self):#{{{
+        """Flushes, closes all files and unlocks the directory.
+
+        """
+        with self._lock:
+            if self._lock_fd is None:
+                return
+            self._flush()
+            self._db.close()
+            for fd in [self._segment_fd] + list(self._read_fds.values()):
+                os.close(fd)
+            self._read_fds = dict()
+            # closing the last descriptor releases the flock
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        #}}}
+
+
+    def start_compaction(self, interval = 600):#{{{
+        """Runs :meth:`compact` every `interval` seconds in a daemon thread
+        until the handler is closed.
+
+        """
+        def compact_periodically():
+            while True:
+                time.sleep(interval)
+                if self._lock_fd is None:
+                    break
+                try:
+                    self.compact()
+                except Exception:
+                    log.exception('pack.storage.compact failed')
+        if self._compactor is None:
+            self._compactor = threading.Thread(target=compact_periodically)
+            self._compactor.daemon = True
+            self._compactor.start()
+        #}}}
+
+
+    def _connect(self):#{{{
+        # transactions are begun and committed explicitly by _update and
+        # _flush, the lock of the handler serializes the use of _db
+        db = sqlite3.connect(self._index_path, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=%s' % ('OFF' if self.durability == 'none' else 'FULL'))
+        return db
+        #}}}
+
+
+    def _lookup(self, path):
+        return self._db.execute('SELECT segment, offset, length, mtime FROM objects WHERE path = ?', (_pack_path(path),)).fetchone()
+
+
+    def _range(self, start, inclusive, end):#{{{
+        """Returns the next batch of indexed paths from start on, up to
+        but excluding end.
+
+        """
+        sql = 'SELECT path FROM objects WHERE path %s ?' % ('>=' if inclusive else '>')
+        args = [start]
+        if end is not None:
+            sql += ' AND path < ?'
+            args.append(end)
+        sql += ' ORDER BY path LIMIT ?'
+        args.append(self.list_batch_size)
+        # no cursor is kept open while the caller iterates
+        with self._lock:
+            return [row[0] for row in self._db.execute(sql, args)]
+        #}}}
+
+
+    def _lock_directory(self):#{{{
+        if fcntl is None:
+            raise StorageError('PackHandler needs fcntl to lock %s' % self.storage_path)
+        self._lock_fd = os.open(self.storage_path, os.O_RDONLY)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                raise
+            raise StorageError('%s is in use by another PackHandler' % self.storage_path)
+        #}}}
+
+
+    def _append_object(self, data):#{{{
+        """Appends data to the active segment, rolling over to a new one
+        once it is full. Returns (segment, offset, length).
+
+        """
+        if self._segment_offset >= self.segment_size:
+            self._open_segment(self._next_segment())
+        start = self._segment_offset
+        try:
+            if is_stream(data):
+                for chunk in data:
+                    write_buffers(self._segment_fd, [chunk])
+                    self._segment_offset += buffer_size(chunk)
+            else:
+                if not isinstance(data, (list, tuple)):
+                    data = [data]
+                write_buffers(self._segment_fd, data)
+                self._segment_offset += buffer_size(data)
+        except Exception:
+            # objects are found by offset, what was written of this one
+            # must not shift the ones after it
+            try:
+                os.ftruncate(self._segment_fd, start)
+            finally:
+                self._segment_offset = os.fstat(self._segment_fd).st_size
+            raise
+        self._unsynced_segments.add(self._segment)
+        return self._segment, start, self._segment_offset - start
+        #}}}
+
+
+    def _update(self, statements):#{{{
+        """Runs (sql, args) statements changing the index.
+
+        They become part of the transaction committed by the next flush,
+        or right away depending on the durability level.
+
+        """
+        if not self._in_transaction:
+            self._db.execute('BEGIN')
+            self._in_transaction = True
+        for sql, args in statements:
+            self._db.execute(sql, args)
+        if self.durability == 'none':
+            self._commit()
+        elif self.durability == 'per-file':
+            self._flush()
+        #}}}
+
+
+    def _commit(self):
+        if self._in_transaction:
+            self._db.execute('COMMIT')
+            self._in_transaction = False
+
+
+    def _flush(self):#{{{
+        if not self._unsynced_segments and not self._in_transaction:
+            return
+        for segment in sorted(self._unsynced_segments):
+            if segment == self._segment:
+                os.fsync(self._segment_fd)
+            else:
+                fsync_path(self._segment_path(segment))
+        self._unsynced_segments = set()
+        if self._new_segments:
+            fsync_path(self.storage_path)
+            self._new_segments = False
+        self._commit()
+        #}}}
+
+
+    def _next_segment(self):
+        self._last_segment += 1
+        return self._last_segment
+
+
+    def _segments(self):
+        return sorted(int(x[:-5]) for x in os.listdir(self.storage_path) if x.endswith('.pack'))
+
+
+    def _segment_path(self, segment):
+        return os.path.join(self.storage_path, '%08d.pack' % segment)
+
+
+    def _open_segment(self, segment):#{{{
+        if getattr(self, '_segment_fd', None) is not None:
+            os.close(self._segment_fd)
+        path = self._segment_path(segment)
+        if not os.path.exists(path):
+            self._new_segments = True
+        self._segment = segment
+        self._segment_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._segment_offset = os.fstat(self._segment_fd).st_size
+        #}}}
+
+
+    def _read_fd(self, segment):
+        if segment not in self._read_fds:
+            self._read_fds[segment] = os.open(self._segment_path(segment), os.O_RDONLY)
+        return self._read_fds[segment]
+
+
+
+class _SegmentWriter(object):
+    """
+    Appends extents copied out of sealed segments to new segments of a
+    :class:`PackHandler`, for :meth:`PackHandler.compact`.
+
+    """
+
+    def __init__(self, handler):
+        self._handler = handler
+        self._segment = self._fd = None
+        self._offset = 0
+
+
+    def copy(self, segment, extents):#{{{
+        """Copies the (offset, length) extents of segment.
+
+        Returns a list of ((offset, length), (new segment, new offset)).
+        The copies are fsynced but not referenced by the index yet.
+
+        """
+        handler = self._handler
+        moved = list()
+        created = False
+        read_fd = os.open(handler._segment_path(segment), os.O_RDONLY)
+        try:
+            for offset, length in extents:
+                if self._fd is None or self._offset >= handler.segment_size:
+                    self.close()
+                    with handler._lock:
+                        self._segment = handler._next_segment()
+                    self._fd = os.open(handler._segment_path(self._segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    self._offset = 0
+                    created = True
+                for chunk in _pread_chunks(read_fd, offset, length):
+                    write_buffers(self._fd, [chunk])
+                moved.append(((offset, length), (self._segment, self._offset)))
+                self._offset += length
+            if self._fd is not None:
+                os.fsync(self._fd)
+        finally:
+            os.close(read_fd)
+        if created:
+            fsync_path(handler.storage_path)
+        return moved
+        #}}}
+
+
+    def close(self):
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+
+def _pack_path(path):
+    if path.startswith('/'):
+        path = path[1:]
+    return path
+
+
+def _prefix_end(prefix):
+    """Returns the first string sorting after all strings starting with
+    prefix, None for the empty prefix.
+
+    """
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _pread_chunks(fd, offset, length, chunk_size=CHUNK_SIZE):#{{{
+    while length > 0:
+        chunk = os.pread(fd, min(length, chunk_size), offset)
+        if not chunk:
+            raise StorageError('segment is shorter than its index claims')
+        yield chunk
+        offset += len(chunk)
+        length -= len(chunk)
+    #}}}
+
+
+
+
+
+
+class ReplicatedHandler(object):
+    """
+    Mirrors writes and deletes to several handlers in parallel.
+
+    A write returns as soon as `write_quorum` replicas (by default a
+    majority) acknowledged it, the others keep working in the background.
+    Every replica applies its writes in order on its own thread, writes are
+    queued on all of them in the same order. Replicas that failed a write
+    are brought up to date by a repair thread every `repair_interval`
+    seconds, the repair is queued behind the writes of the replica.
+
+    Reads go to the fastest healthy replica that is up to date for the
+    path. If it did not answer after `hedge_after` seconds, the next one
+    is asked as well and the first answer wins.
+
+    Versions for conditional writes always come from the first replica
+    given, after the writes queued on it, so the token of a path does not
+    change with the replica asked. If the first replica is lagging behind
+    for the path, it is repaired first, :class:`StorageError` is raised if
+    that fails.
+
+    """
+
+    def __init__(self, handlers, write_quorum = None, hedge_after = 0.05, repair_interval = 5):#{{{
+        self.handlers = list(handlers)
+        if not self.handlers:
+            raise StorageError('at least one replica is needed')
+        self.write_quorum = write_quorum or len(self.handlers) // 2 + 1
+        if self.write_quorum > len(self.handlers):
+            raise StorageError('write quorum %s exceeds %s replicas' % (self.write_quorum, len(self.handlers)))
+        self.hedge_after = hedge_after
+        self.repair_interval = repair_interval
+
+        self._lock = threading.Lock()
+        # keeps the order of writes the same on all replicas
+        self._submit_lock = threading.RLock()
+        self._latency = [0.0 for handler in self.handlers]
+        self._healthy = [True for handler in self.handlers]
+        self._queued = [dict() for handler in self.handlers]
+        self._lagging = [set() for handler in self.handlers]
+        self._writers = [ThreadPoolExecutor(max_workers=1) for handler in self.handlers]
+        self._readers = ThreadPoolExecutor(max_workers=4 * len(self.handlers))
+
+        repairer = threading.Thread(target=self._repair_periodically)
+        repairer.daemon = True
+        repairer.start()
+        #}}}
+
+
+    def has(self, path):
+        return self._read('has', path)
+
+
+    def stat(self, path):
+        return self._read('stat', path)
+
+
+    def version(self, path):#{{{
+        with self._lock:
+            lagging = path in self._lagging[0]
+        if lagging:
+            try:
+                self._repair(0, path).result()
+            except Exception as e:
+                raise StorageError('replica 0 could not be repaired for %s: %s' % (path, e))
+        return self._writers[0].submit(self._version, path).result()
+        #}}}
+
+
+    def list(self, path):
+        return self._read('list', path, collect=True)
+
+
+    def walk(self, path='', **kwargs):
+        return self._read('walk', path, collect=True, **kwargs)
+
+
+    def read(self, path, **kwargs):
+        return self._read('read', path, **kwargs)
+
+
+    def write(self, path, data, **kwargs):#{{{
+        if is_stream(data):
+            # every replica needs its own pass over the data, keep it on
+            # disk rather than in memory
+            data = _Spool(data)
+        elif not isinstance(data, (bytes, str)):
+            # replicas still writing after we returned must not see the
+            # caller changing a bytearray or memoryview
+            data = bytes(as_buffer(data))
+        return self._write('write', [path], path, data)
+        #}}}
+
+
+    def delete(self, path, **kwargs):
+        return self._write('delete', [path], path, missing_ok=True)
+
+
+    def copy(self, src, dst, **kwargs):
+        return self._write('copy', [dst], src, dst, sources=[src])
+
+
+    def move(self, src, dst, **kwargs):
+        return self._write('move', [src, dst], src, dst, sources=[src])
+
+
+    def lock_paths(self, paths):#{{{
+        """Locks paths on every replica supporting it, returns a function
+        releasing the locks.
+
+        """
+        releases = list()
+        try:
+            for handler in self.handlers:
+                if hasattr(handler, 'lock_paths'):
+                    releases.append(handler.lock_paths(paths))
+        except Exception:
+            for release in reversed(releases):
+                release()
+            raise
+        def release():
+            for release_replica in reversed(releases):
+                release_replica()
+        return release
+        #}}}
+
+
+    def flush(self):#{{{
+        """Flushes all replicas, returns once a write quorum has flushed.
+
+        A replica flushes after all writes queued before on it.
+
+        """
+        return self._write('flush', [])
+        #}}}
+
+
+    def repair(self):#{{{
+        """Copies the paths a replica missed from an up to date replica.
+
+        Returns the number of paths that are still lagging behind.
+
+        """
+        for i in range(len(self.handlers)):
+            with self._lock:
+                paths = list(self._lagging[i])
+            for path in paths:
+                try:
+                    self._repair(i, path).result()
+                except Exception as e:
+                    # still down, try again on the next run
+                    log.warning('replicated.storage.repair: replica=%(replica)s, path=%(path)s, error=%(error)s' % dict(replica=i, path=path, error=e))
+                    break
+        with self._lock:
+            return sum(len(lagging) for lagging in self._lagging)
+        #}}}
+
+
+    def _repair(self, i, path):#{{{
+        """Queues copying path to replica i, returns the future of it.
+
+        """
+        return self._submit(i, [path], [], True, self._restore, i, path)
+        #}}}
+
+
+    def _restore(self, i, path):#{{{
+        # runs on the writer of replica i, the source is picked only now
+        # and read here, waiting for another writer could deadlock
+        sources = self._up_to_date(path, [j for j in self._by_latency() if j != i])
+        if not sources:
+            raise StorageError('no replica is up to date for %s' % path)
+        source = self.handlers[sources[0]]
+        if source.has(path):
+            self._call(i, 'write', path, iter_chunks(source, path))
+        else:
+            self._call(i, 'delete', path)
+        log.debug('replicated.storage.repair: replica=%(replica)s, path=%(path)s' % dict(replica=i, path=path))
+        #}}}
+
+
+    def _version(self, path):
+        # runs on the writer of replica 0, behind the writes queued before
+        with self._lock:
+            if path in self._lagging[0]:
+                raise StorageError('replica 0 is lagging behind for %s' % path)
+        return self._call(0, 'version', path)
+
+
+    def _repair_periodically(self):
+        while True:
+            time.sleep(self.repair_interval)
+            self.repair()
+
+
+    def _write(self, name, paths, *args, **kwargs):#{{{
+        missing_ok = kwargs.pop('missing_ok', False)
+        sources = kwargs.pop('sources', [])
+        pending = set()
+        with self._submit_lock:
+            for i in range(len(self.handlers)):
+                pending.add(self._submit(i, paths, sources, missing_ok, self._call, i, name, *args))
+
+        acknowledged = 0
+        errors = list()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    future.result()
+                    acknowledged += 1
+                except NoSuchFile as e:
+                    if missing_ok:
+                        acknowledged += 1
+                    else:
+                        errors.append(e)
+                except Exception as e:
+                    errors.append(e)
+            if acknowledged >= self.write_quorum:
+                return True
+            if acknowledged + len(pending) < self.write_quorum:
+                break
+        log.warning('replicated.storage.%(name)s: %(count)s replicas acknowledged, %(quorum)s needed' % dict(name=name, count=acknowledged, quorum=self.write_quorum))
+        if errors and all(isinstance(e, NoSuchFile) for e in errors):
+            raise errors[0]
+        raise StorageError('write quorum not reached: %s' % ', '.join(str(e) for e in errors))
+        #}}}
+
+
+    def _submit(self, i, paths, sources, missing_ok, fn, *args):#{{{
+        """Queues fn on the writer of replica i, paths count as queued
+        until it finished.
+
+        """
+        with self._submit_lock:
+            with self._lock:
+                for path in paths:
+                    self._queued[i][path] = self._queued[i].get(path, 0) + 1
+            return self._writers[i].submit(self._job, i, paths, sources, missing_ok, fn, *args)
+        #}}}
+
+
+    def _job(self, i, paths, sources, missing_ok, fn, *args):#{{{
+        # the bookkeeping is done before the next job of the replica starts
+        # and before anyone waiting for this one wakes up
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._written(i, paths, sources, missing_ok, e)
+            raise
+        self._written(i, paths, sources, missing_ok, None)
+        return result
+        #}}}
+
+
+    def _written(self, i, paths, sources, missing_ok, error):#{{{
+        with self._lock:
+            for path in paths:
+                self._queued[i][path] -= 1
+                if not self._queued[i][path]:
+                    del(self._queued[i][path])
+            if error is not None and not (missing_ok and isinstance(error, NoSuchFile)):
+                self._lagging[i].update(paths)
+            elif any(source in self._lagging[i] for source in sources):
+                # copied from stale data, or not at all
+                self._lagging[i].update(paths)
+            else:
+                # the replica is up to date unless a newer write is still
+                # to come, that one decides
+                self._lagging[i].difference_update([path for path in paths if path not in self._queued[i]])
+        #}}}
+
+
+    def _read(self, name, path, collect=False, **kwargs):#{{{
+        replicas = self._up_to_date(path, self._by_latency()) or self._by_latency()
+        pending = set()
+        errors = list()
+        while True:
+            # ask the next replica whenever the last one timed out or failed
+            if replicas:
+                i = replicas.pop(0)
+                if collect:
+                    pending.add(self._readers.submit(lambda i=i: list(self._call(i, name, path, **kwargs))))
+                else:
+                    pending.add(self._readers.submit(self._call, i, name, path, **kwargs))
+            if not pending:
+                raise errors[0]
+            done, pending = wait(pending, timeout=self.hedge_after if replicas else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except NoSuchFile:
+                    # the replica is up to date for path, believe it
+                    raise
+                except Exception as e:
+                    errors.append(e)
+        #}}}
+
+
+    def _call(self, i, name, *args, **kwargs):#{{{
+        args = [arg.chunks() if isinstance(arg, _Spool) else arg for arg in args]
+        start = time.time()
+        try:
+            result = getattr(self.handlers[i], name)(*args, **kwargs)
+        except NoSuchFile:
+            self._measure(i, start, True)
+            raise
+        except Exception:
+            self._measure(i, start, False)
+            raise
+        self._measure(i, start, True)
+        return result
+        #}}}
+
+
+    def _measure(self, i, start, healthy):
+        with self._lock:
+            self._latency[i] = 0.8 * self._latency[i] + 0.2 * (time.time() - start)
+            self._healthy[i] = healthy
+
+
+    def _by_latency(self):
+        with self._lock:
+            return sorted(range(len(self.handlers)), key=lambda i: (not self._healthy[i], self._latency[i]))
+
+
+    def _up_to_date(self, path, replicas):
+        with self._lock:
+            return [i for i in replicas if path not in self._queued[i] and path not in self._lagging[i]]
+
+
+
+class _Spool(object):
+    """
+    A stream written to an anonymous temporary file, which can be read
+    back any number of times. The file goes away with the last reference.
+
+    """
+
+    def __init__(self, data):
+        self._file = tempfile.TemporaryFile()
+        self.size = 0
+        for chunk in data:
+            write_buffers(self._file.fileno(), [chunk])
+            self.size += buffer_size(chunk)
+
+    def chunks(self):
+        return _pread_chunks(self._file.fileno(), 0, self.size)
 
 
 
@@ -156,9 +1548,18 @@ class DevNullStorage(object):
     def has(self, path):
         return False
 
+    def stat(self, path):
+        raise NoSuchFile(path)
+
+    def version(self, path):
+        raise NoSuchFile(path)
+
     def list(self, path):
         return []
 
+    def walk(self, path='', **kwargs):
+        return []
+
     def read(self, path, **kwargs):
         return None
 
@@ -168,6 +1569,15 @@ class DevNullStorage(object):
     def delete(self, path, **kwargs):
         return True
 
+    def copy(self, src, dst, **kwargs):
+        return True
+
+    def move(self, src, dst, **kwargs):
+        return True
+
+    def flush(self):
+        pass
+
     def lock(self, path):
         pass
 
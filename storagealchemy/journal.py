@@ -0,0 +1,329 @@
+# -*- coding:utf8 -*-
+
+import logging
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+from .exception import StorageError
+from .handler import CHUNK_SIZE, as_buffer, write_buffers, fsync_path
+
+log = logging.getLogger(__name__)
+
+
+# every record is framed as (meta length, data length, crc32) followed by
+# the pickled meta tuple and the raw payload
+_frame = struct.Struct('>III')
+
+
+
+class Journal(object):
+    """
+    Append-only log of storage operations that have been committed but not
+    yet applied to their handlers.
+
+    Operations are fsynced before :meth:`append` returns, so an operation
+    which made it into the journal survives a crash and is handed out again
+    by :meth:`pending` on the next start. Applying an operation twice must
+    be harmless, writes and deletes of whole files are. For the same reason
+    an operation marked as done retires the older operations on its uri
+    that are still pending, they were replaced.
+
+    Only the position of a payload within the file is kept in memory, it is
+    read back by :meth:`payload` or :meth:`read` when needed. Once the file has grown beyond
+    `compact_size` and less than half of it is still pending, the pending
+    records are copied into a fresh file which replaces it.
+
+    """
+
+    def __init__(self, path, compact_size=64 * 1024 * 1024):#{{{
+        self.path = os.path.realpath(path)
+        self.compact_size = compact_size
+        self._lock = threading.Lock()
+        self._seq = 0
+        # seq -> (uri, action, text, record offset, meta length, data length)
+        self._pending = dict()
+        # uri -> seqs of its pending operations
+        self._uris = dict()
+        self._live = 0
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        created = not os.path.exists(self.path)
+
+        self._load()
+        self._open()
+        if created:
+            fsync_path(directory)
+        #}}}
+
+
+    def pending(self):
+        """Returns (seq, uri, action) of all operations not marked as done,
+        oldest first.
+
+        """
+        with self._lock:
+            return [(seq,) + self._pending[seq][:2] for seq in sorted(self._pending)]
+
+
+    def payload(self, seq):#{{{
+        """Reads the data of a pending operation back from the journal.
+
+        """
+        with self._lock:
+            uri, action, text, offset, meta_len, data_len = self._pending[seq]
+            if action == 'delete':
+                return None
+            data = self._pread(offset + _frame.size + meta_len, data_len)
+        if text:
+            # the payload was text when it was journaled
+            data = data.decode('utf-8')
+        return data
+        #}}}
+
+
+    def read(self, seq, offset=0, length=None):#{{{
+        """Returns a range of the payload of a pending write as bytes, or
+        None if the operation is not pending anymore.
+
+        """
+        with self._lock:
+            entry = self._pending.get(seq)
+            if entry is None:
+                return None
+            uri, action, text, start, meta_len, data_len = entry
+            offset = min(offset, data_len)
+            if length is None or offset + length > data_len:
+                length = data_len - offset
+            return self._pread(start + _frame.size + meta_len + offset, length)
+        #}}}
+
+
+    def size(self, seq):#{{{
+        """Returns the size of the payload of a pending write in bytes, or
+        None if the operation is not pending anymore.
+
+        """
+        with self._lock:
+            entry = self._pending.get(seq)
+        if entry is None:
+            return None
+        return entry[5]
+        #}}}
+
+
+    def append(self, operations):#{{{
+        """Durably appends a list of (uri, action, data) operations.
+
+        Returns the sequence numbers assigned to the operations.
+
+        """
+        chunks = list()
+        entries = list()
+        with self._lock:
+            offset = self._size
+            for uri, action, data in operations:
+                self._seq += 1
+                record = _record(('op', self._seq, uri, action), data)
+                entries.append((self._seq, (uri, action, isinstance(data, str), offset, len(record[1]), len(record[2]))))
+                chunks.extend(record)
+                offset += sum(len(chunk) for chunk in record)
+            self._write(chunks, sync=True)
+            self._live += offset - self._size
+            self._size = offset
+            for seq, entry in entries:
+                self._track(seq, entry)
+        return [seq for seq, entry in entries]#}}}
+
+
+    def done(self, seqs):#{{{
+        """Marks operations as applied.
+
+        Done markers are not fsynced, losing them only means the operation
+        gets applied once more. The journal is truncated as soon as nothing
+        is pending anymore.
+
+        """
+        if not seqs:
+            return
+        with self._lock:
+            for seq in seqs:
+                self._retire(seq)
+            if not self._pending:
+                os.ftruncate(self._fd, 0)
+                self._size = self._live = 0
+            elif self._size >= self.compact_size and self._live * 2 < self._size:
+                self._compact()
+            else:
+                chunks = [chunk for seq in seqs for chunk in _record(('done', seq, None, None))]
+                self._write(chunks)
+                self._size += sum(len(chunk) for chunk in chunks)
+        #}}}
+
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                os.close(self._read_fd)
+                self._fd = self._read_fd = None
+
+
+    def _track(self, seq, entry):
+        self._pending[seq] = entry
+        self._uris.setdefault(entry[0], set()).add(seq)
+
+
+    def _retire(self, seq):#{{{
+        """Drops seq from the pending operations, along with the older ones
+        on the same uri.
+
+        """
+        if seq not in self._pending:
+            return
+        uri = self._pending[seq][0]
+        seqs = self._uris.pop(uri)
+        for older in [x for x in seqs if x <= seq]:
+            entry = self._pending.pop(older)
+            self._live -= _frame.size + entry[4] + entry[5]
+            seqs.discard(older)
+        if seqs:
+            self._uris[uri] = seqs
+        #}}}
+
+
+    def _write(self, chunks, sync=False):#{{{
+        """Writes chunks at the end of the journal.
+
+        If that fails, whatever part of them made it into the file is cut
+        off again. Records are located by their offset and :meth:`_load`
+        stops at the first torn one, so a torn record in the middle would
+        hide every record appended after it.
+
+        """
+        try:
+            write_buffers(self._fd, chunks)
+            if sync:
+                os.fsync(self._fd)
+        except Exception:
+            os.ftruncate(self._fd, self._size)
+            raise
+        #}}}
+
+
+    def _pread(self, offset, length):#{{{
+        chunks = list()
+        while length > 0:
+            chunk = os.pread(self._read_fd, length, offset)
+            if not chunk:
+                raise StorageError('journal %s is shorter than its records' % self.path)
+            chunks.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+        #}}}
+
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._read_fd = os.open(self.path, os.O_RDONLY)
+        self._size = os.fstat(self._fd).st_size
+
+
+    def _compact(self):#{{{
+        """Replaces the journal by a file holding only the pending records.
+
+        """
+        temp_path = self.path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        pending = dict()
+        offset = 0
+        try:
+            for seq in sorted(self._pending):
+                uri, action, text, start, meta_len, data_len = self._pending[seq]
+                length = _frame.size + meta_len + data_len
+                # records are copied verbatim, their checksums stay valid
+                remaining = length
+                while remaining > 0:
+                    chunk = os.pread(self._read_fd, min(remaining, CHUNK_SIZE), start + length - remaining)
+                    if not chunk:
+                        raise StorageError('journal %s is shorter than its records' % self.path)
+                    write_buffers(fd, [chunk])
+                    remaining -= len(chunk)
+                pending[seq] = (uri, action, text, offset, meta_len, data_len)
+                offset += length
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, self.path)
+        fsync_path(os.path.dirname(self.path))
+        os.close(self._fd)
+        os.close(self._read_fd)
+        self._open()
+        self._pending = pending
+        log.debug('journal: compacted %(path)s, pending=%(count)s, size=%(size)s' % dict(path=self.path, count=len(pending), size=offset))
+        #}}}
+
+
+    def _load(self):#{{{
+        if not os.path.isfile(self.path):
+            return
+        size = os.path.getsize(self.path)
+
+        offset = 0
+        with open(self.path, 'rb') as fp:
+            while offset + _frame.size <= size:
+                meta_len, data_len, crc = _frame.unpack(fp.read(_frame.size))
+                end = offset + _frame.size + meta_len + data_len
+                if end > size:
+                    break
+                meta = fp.read(meta_len)
+                # payloads are only checked here, not kept in memory
+                checksum = zlib.crc32(meta)
+                remaining = data_len
+                while remaining > 0:
+                    chunk = fp.read(min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    checksum = zlib.crc32(chunk, checksum)
+                    remaining -= len(chunk)
+                if remaining or checksum & 0xffffffff != crc:
+                    break
+                kind, seq, uri, action = pickle.loads(meta)
+                if kind == 'op':
+                    text = isinstance(uri, tuple)
+                    if text:
+                        uri = uri[0]
+                    self._track(seq, (uri, action, text, offset, meta_len, data_len))
+                    self._live += end - offset
+                else:
+                    self._retire(seq)
+                self._seq = max(self._seq, seq)
+                offset = end
+
+        if offset < size:
+            # a torn record at the end was never acknowledged, drop it
+            log.warning('journal: discarding %(count)s trailing bytes of %(path)s' % dict(count=size - offset, path=self.path))
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(offset)
+                fp.flush()
+                os.fsync(fp.fileno())
+        #}}}
+
+
+
+def _record(meta, data=None):
+    if data is None:
+        data = b''
+    elif isinstance(data, str):
+        # remember to hand text back as text on replay
+        meta = (meta[0], meta[1], (meta[2],), meta[3])
+    data = as_buffer(data)
+    meta = pickle.dumps(meta, 2)
+    crc = zlib.crc32(data, zlib.crc32(meta)) & 0xffffffff
+    return [_frame.pack(len(meta), len(data), crc), meta, data]
+
@@ -0,0 +1,214 @@
+# -*- coding:utf8 -*-
+"""
+Finds stored files that no database row refers to (orphans) and
+references to files that do not exist (dangling references).
+
+Both sides are streamed through an external sort and merged, so memory
+stays bounded by `chunk_size` no matter how large the storage is::
+
+    for kind, uri in scan(handler, Image.uri, 'images'):
+        print(kind, uri)
+
+or from the command line::
+
+    storagealchemy-orphans --db-url mysql://... --column myapp.models:Image.uri \\
+                           --scheme images --root /srv/images
+
+"""
+
+import argparse
+import heapq
+import importlib
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import transaction
+
+from .exception import StorageError
+
+log = logging.getLogger(__name__)
+
+
+ORPHAN = 'orphan'
+DANGLING = 'dangling'
+
+
+
+def scan(handler, column, scheme, session=None, path='', workers=8, batch_size=10000, chunk_size=1000000, new_transaction=True):
+    #{{{
+    """Yields (ORPHAN, uri) and (DANGLING, uri) tuples, sorted by uri.
+
+    Stored files come from ``handler.walk(path)``, references from
+    `column` for all uris below ``scheme://path/``. Files are listed
+    completely before the references are queried, so a file written after
+    a commit is never reported because its row is still missing, as long
+    as the query sees a snapshot taken after the walk. To make sure of
+    that, any transaction open on `session` is rolled back right before the
+    query, discarding its uncommitted changes. Pass `new_transaction` as
+    False to query within the open transaction instead, its snapshot may
+    be older than the walk, so do not delete what such a scan reports.
+
+    """
+    if session is None:
+        import sqlahelper
+        session = sqlahelper.get_session()
+    prefix = '%s://' % scheme
+    path = path.strip('/')
+
+    # sorting consumes the whole walk before the first reference is read
+    stored = _external_sort(handler.walk(path, workers=workers), chunk_size)
+
+    if new_transaction:
+        session.rollback()
+    pattern = prefix + path + '/' if path else prefix
+    query = session.query(column)\
+        .filter(column.like(_escape_like(pattern) + '%', escape='\\'))\
+        .yield_per(batch_size)
+    referenced = _external_sort((row[0][len(prefix):] for row in query), chunk_size)
+
+    for kind, path in _merge(stored, referenced):
+        yield kind, prefix + path
+    #}}}
+
+
+def delete_orphans(storage, uris, batch_size=1000):
+    #{{{
+    """Deletes uris through `storage`, committing a transaction for every
+    `batch_size` deletes. Returns the number of deleted uris.
+
+    """
+    count = 0
+    for uri in uris:
+        storage.delete(uri)
+        count += 1
+        if not count % batch_size:
+            transaction.commit()
+    transaction.commit()
+    return count
+    #}}}
+
+
+def main(argv=None):
+    #{{{
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--db-url', required=True, help='sqlalchemy database url')
+    parser.add_argument('--column', required=True, help='column holding the uris, as module:Model.attribute')
+    parser.add_argument('--scheme', required=True, help='uri scheme of the stored files')
+    parser.add_argument('--root', required=True, help='storage path of the FilesystemHandler')
+    parser.add_argument('--path', default='', help='only scan below this path')
+    parser.add_argument('--workers', type=int, default=8, help='directories scanned in parallel')
+    parser.add_argument('--delete', action='store_true', help='delete the orphans')
+    args = parser.parse_args(argv)
+
+    import sqlalchemy as sa
+    import sqlahelper
+
+    engine = sa.create_engine(args.db_url)
+    sqlahelper.add_engine(engine)
+
+    from . import Storage
+    from .handler import FilesystemHandler
+
+    st = os.stat(args.root)
+    handler = FilesystemHandler(args.root, st.st_uid, st.st_gid)
+    column = _import_column(args.column)
+
+    def report():
+        for kind, uri in scan(handler, column, args.scheme, path=args.path, workers=args.workers):
+            sys.stdout.write('%s\t%s\n' % (kind, uri))
+            if kind == ORPHAN:
+                yield uri
+
+    if args.delete:
+        # both sides are sorted completely before merging, so committing
+        # the deletes does not disturb the reference query
+        storage = Storage()
+        storage.add_handler(args.scheme, handler)
+        log.info('orphans: deleted %(count)s files' % dict(count=delete_orphans(storage, report())))
+    else:
+        for uri in report():
+            pass
+    #}}}
+
+
+
+def _import_column(spec):#{{{
+    try:
+        module, attribute = spec.split(':')
+        obj = importlib.import_module(module)
+        for name in attribute.split('.'):
+            obj = getattr(obj, name)
+    except (ValueError, ImportError, AttributeError):
+        raise StorageError('could not import column %s' % spec)
+    return obj
+    #}}}
+
+
+def _escape_like(value):
+    for char in ('\\', '%', '_'):
+        value = value.replace(char, '\\' + char)
+    return value
+
+
+def _external_sort(iterable, chunk_size):#{{{
+    """Returns an iterator over the sorted, distinct items of iterable.
+
+    Items are sorted in chunks of `chunk_size`, chunks beyond the first
+    are spilled to temporary files and merged.
+
+    """
+    chunks = list()
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            chunks.append(_spill(sorted(chunk)))
+            chunk = list()
+    chunk.sort()
+    if chunks:
+        chunks.append(_spill(chunk))
+        merged = heapq.merge(*[_unspill(fp) for fp in chunks])
+    else:
+        merged = iter(chunk)
+    return (item for item, group in itertools.groupby(merged))
+    #}}}
+
+
+def _spill(items):
+    fp = tempfile.TemporaryFile(mode='w+')
+    for item in items:
+        # json keeps newlines in paths on one line
+        fp.write(json.dumps(item) + '\n')
+    fp.seek(0)
+    return fp
+
+
+def _unspill(fp):
+    with fp:
+        for line in fp:
+            yield json.loads(line)
+
+
+def _merge(stored, referenced):#{{{
+    a = next(stored, None)
+    b = next(referenced, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a < b):
+            yield ORPHAN, a
+            a = next(stored, None)
+        elif a is None or b < a:
+            yield DANGLING, b
+            b = next(referenced, None)
+        else:
+            a = next(stored, None)
+            b = next(referenced, None)
+    #}}}
+
+
+
+if __name__ == '__main__':
+    main()
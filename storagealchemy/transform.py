@@ -0,0 +1,462 @@
+# -*- coding:utf8 -*-
+"""
+Transform stages applied to payloads between :class:`storagealchemy.Storage`
+and a handler, see the `pipeline` argument of
+:meth:`storagealchemy.Storage.add_handler`::
+
+    pipeline = Pipeline([Compress(), Checksum()])
+    storage.add_handler('images', handler, pipeline=pipeline)
+
+Stages are pickled into worker processes, so custom stages and the
+callables given to :class:`Transform` have to be defined at module level.
+
+"""
+
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .exception import StorageError, CorruptData
+from .handler import as_buffer, buffer_size, is_stream
+
+log = logging.getLogger(__name__)
+
+
+# the decoded size of a payload, appended to what the stages encoded
+_trailer = struct.Struct('>Q')
+
+
+class Checksum(object):
+    """
+    Appends a digest of the payload, verified and stripped on decode.
+
+    """
+
+    def __init__(self, algorithm='sha256'):
+        self.algorithm = algorithm
+        self.digest_size = hashlib.new(algorithm).digest_size
+
+    def encode(self, data):
+        data = as_buffer(data)
+        return data.tobytes() + hashlib.new(self.algorithm, data).digest()
+
+    def decode(self, data):#{{{
+        data = as_buffer(data)
+        payload, digest = data[:-self.digest_size], data[-self.digest_size:]
+        if len(digest) != self.digest_size or hashlib.new(self.algorithm, payload).digest() != digest:
+            raise CorruptData('%s checksum mismatch' % self.algorithm)
+        return payload.tobytes()
+        #}}}
+
+    def encoder(self):
+        return _ChecksumEncoder(hashlib.new(self.algorithm))
+
+    def decoder(self):
+        return _ChecksumDecoder(hashlib.new(self.algorithm), self.algorithm)
+
+
+
+class Compress(object):
+    """
+    Compresses payloads with zlib.
+
+    """
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def encode(self, data):
+        return zlib.compress(as_buffer(data), self.level)
+
+    def decode(self, data):
+        try:
+            return zlib.decompress(as_buffer(data))
+        except zlib.error as e:
+            raise CorruptData(str(e))
+
+    def encoder(self):
+        return _CompressEncoder(zlib.compressobj(self.level))
+
+    def decoder(self):
+        return _CompressDecoder(zlib.decompressobj())
+
+
+
+class Encrypt(object):
+    """
+    Encrypts payloads with AES-GCM, needs the `cryptography` package
+    (``pip install StorageAlchemy[encrypt]``).
+
+    `key` has to be 16, 24 or 32 bytes long. Every payload gets a random
+    nonce which is stored in front of the ciphertext.
+
+    """
+
+    nonce_size = 12
+
+    def __init__(self, key):
+        if _aesgcm() is None:
+            raise StorageError('Encrypt needs the cryptography package')
+        self.key = key
+
+    def encode(self, data):
+        nonce = os.urandom(self.nonce_size)
+        return nonce + _aesgcm()(self.key).encrypt(nonce, as_buffer(data).tobytes(), None)
+
+    def decode(self, data):#{{{
+        data = as_buffer(data).tobytes()
+        try:
+            return _aesgcm()(self.key).decrypt(data[:self.nonce_size], data[self.nonce_size:], None)
+        except Exception:
+            raise CorruptData('payload could not be decrypted')
+        #}}}
+
+
+
+class Transform(object):
+    """
+    Stage made of two callables taking and returning bytes.
+
+    """
+
+    def __init__(self, encode, decode=None):
+        self._encode = encode
+        self._decode = decode
+
+    def encode(self, data):
+        return self._encode(as_buffer(data).tobytes())
+
+    def decode(self, data):
+        if self._decode is None:
+            return data
+        return self._decode(as_buffer(data).tobytes())
+
+
+
+class Pipeline(object):
+    """
+    Runs payloads through a list of stages, in order when encoding and in
+    reverse when decoding.
+
+    The size of the payload is appended to the encoded data as an 8 byte
+    trailer, :meth:`decoded_size` reads it back without decoding anything.
+    :meth:`decode_range` decodes only as much at a time as the stages need
+    if every stage has a `decoder`, the whole payload otherwise.
+
+    :meth:`encode_many` encodes the payloads of a commit on a pool of
+    `processes` worker processes once they add up to `min_parallel_size`
+    bytes. Payloads of at least `stream_size` bytes are not sent to the
+    workers but streamed through incremental encoders in chunks of
+    `chunk_size`, if every stage has one.
+
+    Workers are started through a forkserver where available, forking the
+    calling process would copy the state of its write-behind, fsync and
+    replication threads, locks included.
+
+    """
+
+    trailer_size = _trailer.size
+
+    def __init__(self, stages, processes=None, min_parallel_size=256 * 1024, stream_size=64 * 1024 * 1024, chunk_size=1024 * 1024):
+        self.stages = list(stages)
+        self.processes = processes
+        self.min_parallel_size = min_parallel_size
+        self.stream_size = stream_size
+        self.chunk_size = chunk_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+
+    def encode(self, data):
+        return _encode_framed(self.stages, data)
+
+
+    def decode(self, data):#{{{
+        data = as_buffer(data)
+        size = self.decoded_size(data[-_trailer.size:])
+        data = data[:-_trailer.size]
+        for stage in reversed(self.stages):
+            data = stage.decode(data)
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if len(data) != size:
+            raise CorruptData('decoded %s bytes instead of %s' % (len(data), size))
+        return data
+        #}}}
+
+
+    def decoded_size(self, trailer):#{{{
+        """Returns the decoded size of a payload, given the last 8 bytes
+        of its encoded data.
+
+        """
+        trailer = as_buffer(trailer)
+        if len(trailer) != _trailer.size:
+            raise CorruptData('encoded data is too short for a trailer')
+        return _trailer.unpack(trailer)[0]
+        #}}}
+
+
+    def decode_range(self, chunks, offset=0, length=None):#{{{
+        """Returns `length` decoded bytes from `offset` on, given an
+        iterator over the encoded chunks of a payload.
+
+        The whole payload is read in any case, so checksums are verified.
+
+        """
+        end = None if length is None else offset + length
+        if not self.decode_streamable():
+            return self.decode(b''.join(as_buffer(chunk) for chunk in chunks))[offset:end]
+        result = list()
+        position = 0
+        for chunk in self.decode_stream(chunks):
+            start = position
+            position += len(chunk)
+            if position > offset and (end is None or start < end):
+                result.append(chunk[max(offset - start, 0):None if end is None else end - start])
+        return b''.join(result)
+        #}}}
+
+
+    def encode_many(self, payloads):#{{{
+        """Returns the encoded payloads, in order.
+
+        Streamed payloads come back as iterators of encoded chunks.
+
+        """
+        result = list(payloads)
+        parallel = list()
+        for n, data in enumerate(result):
+            if self.streamable() and (is_stream(data) or buffer_size(data) >= self.stream_size):
+                result[n] = self.encode_stream(data)
+            else:
+                if is_stream(data):
+                    result[n] = b''.join(as_buffer(chunk) for chunk in data)
+                parallel.append(n)
+
+        size = sum(buffer_size(result[n]) for n in parallel)
+        if size < self.min_parallel_size:
+            for n in parallel:
+                result[n] = self.encode(result[n])
+            return result
+
+        with self._pool_lock:
+            # concurrent commits would start a pool each
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=_mp_context())
+        # memoryviews do not pickle, this is the one copy the workers need
+        jobs = [as_buffer(result[n]).tobytes() for n in parallel]
+        encoded = self._pool.map(functools.partial(_encode_framed, self.stages), jobs)
+        for n, data in zip(parallel, encoded):
+            result[n] = data
+        log.debug('pipeline.encode_many: payloads=%(count)s, size=%(size)s' % dict(count=len(parallel), size=size))
+        return result
+        #}}}
+
+
+    def streamable(self):
+        return all(hasattr(stage, 'encoder') for stage in self.stages)
+
+
+    def decode_streamable(self):
+        return all(hasattr(stage, 'decoder') for stage in self.stages)
+
+
+    def encode_stream(self, data):#{{{
+        """Returns an iterator over the encoded chunks of data, which can
+        be a buffer or an iterator of buffers.
+
+        """
+        if not self.streamable():
+            raise StorageError('not all stages of the pipeline can stream')
+        if not is_stream(data):
+            view = as_buffer(data)
+            data = (view[i:i + self.chunk_size] for i in range(0, len(view), self.chunk_size))
+        encoders = [stage.encoder() for stage in self.stages]
+
+        def chunks():
+            size = 0
+            for chunk in data:
+                size += buffer_size(chunk)
+                for encoder in encoders:
+                    chunk = encoder.update(chunk)
+                if chunk:
+                    yield chunk
+            # what a stage flushes still has to pass the stages after it
+            tail = b''
+            for encoder in encoders:
+                tail = encoder.update(tail) + encoder.finish()
+            yield tail + _trailer.pack(size)
+        return chunks()
+        #}}}
+
+
+    def decode_stream(self, chunks):#{{{
+        """Returns an iterator over the decoded chunks of an iterator over
+        encoded chunks. It raises :class:`CorruptData` at the end if the
+        payload does not check out.
+
+        """
+        if not self.decode_streamable():
+            raise StorageError('not all stages of the pipeline can stream')
+        # the trailer is held back like a checksum, it is last
+        decoders = [_TrailerDecoder()] + [stage.decoder() for stage in reversed(self.stages)]
+
+        def decoded():
+            for chunk in chunks:
+                for decoder in decoders:
+                    chunk = decoder.update(chunk)
+                if chunk:
+                    yield chunk
+            tail = b''
+            for decoder in decoders:
+                tail = decoder.update(tail) + decoder.finish()
+            if tail:
+                yield tail
+        return _checked(decoded(), decoders[0])
+        #}}}
+
+
+
+class _ChecksumEncoder(object):
+
+    def __init__(self, digest):
+        self.digest = digest
+
+    def update(self, chunk):
+        self.digest.update(chunk)
+        return chunk
+
+    def finish(self):
+        return self.digest.digest()
+
+
+
+class _CompressEncoder(object):
+
+    def __init__(self, compressor):
+        self.compressor = compressor
+
+    def update(self, chunk):
+        return self.compressor.compress(chunk)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+
+class _HoldBack(object):
+    """
+    Passes chunks on except for their last `size` bytes, which are kept
+    as `tail`.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tail = b''
+
+    def update(self, chunk):
+        data = self.tail + as_buffer(chunk).tobytes()
+        cut = max(len(data) - self.size, 0)
+        self.tail = data[cut:]
+        return data[:cut]
+
+
+
+class _ChecksumDecoder(_HoldBack):
+
+    def __init__(self, digest, algorithm):
+        super(_ChecksumDecoder, self).__init__(digest.digest_size)
+        self.digest = digest
+        self.algorithm = algorithm
+
+    def update(self, chunk):
+        chunk = super(_ChecksumDecoder, self).update(chunk)
+        self.digest.update(chunk)
+        return chunk
+
+    def finish(self):
+        if len(self.tail) != self.size or self.digest.digest() != self.tail:
+            raise CorruptData('%s checksum mismatch' % self.algorithm)
+        return b''
+
+
+
+class _CompressDecoder(object):
+
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+
+    def update(self, chunk):
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error as e:
+            raise CorruptData(str(e))
+
+    def finish(self):
+        try:
+            data = self.decompressor.flush()
+        except zlib.error as e:
+            raise CorruptData(str(e))
+        if not self.decompressor.eof:
+            raise CorruptData('compressed data is truncated')
+        return data
+
+
+
+class _TrailerDecoder(_HoldBack):
+
+    def __init__(self):
+        super(_TrailerDecoder, self).__init__(_trailer.size)
+
+    def finish(self):
+        if len(self.tail) != self.size:
+            raise CorruptData('encoded data is too short for a trailer')
+        return b''
+
+    def decoded_size(self):
+        return _trailer.unpack(self.tail)[0]
+
+
+
+def _checked(chunks, trailer):
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    if size != trailer.decoded_size():
+        raise CorruptData('decoded %s bytes instead of %s' % (size, trailer.decoded_size()))
+
+
+def _encode(stages, data):
+    for stage in stages:
+        data = stage.encode(data)
+    return data
+
+
+def _encode_framed(stages, data):
+    # runs in the workers as well, the trailer is added there
+    size = buffer_size(data)
+    return b''.join([as_buffer(_encode(stages, data)), _trailer.pack(size)])
+
+
+def _mp_context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _aesgcm():
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        return None
+    return AESGCM
@@ -1,8 +1,11 @@
 import shutil
 
+from unittest import mock
+
 from . import BaseTestCase
 
 from storagealchemy import Storage
+from storagealchemy.exception import StorageError, VersionConflict
 from storagealchemy.handler import FilesystemHandler
 from storagealchemy.test import TestFile
 
@@ -45,7 +48,7 @@ class StorageTest(BaseTestCase):
         path = os.path.join(self.test_storage_path, uri.replace('test://', ''))
         if not os.path.isfile(path):
             return None
-        fh = open(path, 'r')
+        fh = open(path, 'rb')
         return fh.read()#}}}
 
 
@@ -53,7 +56,7 @@ class StorageTest(BaseTestCase):
     def test_committing_session_stores_file(self):
 
         uri = 'test://test_committing_session_stores_file.txt'
-        data = 'test data'
+        data = b'test data'
 
         storage.write(uri, data)
         transaction.commit()
@@ -65,7 +68,7 @@ class StorageTest(BaseTestCase):
     def test_rolling_back_session_does_not_store_file(self):
 
         uri = 'test://test_rolling_back_session_does_not_store_file'
-        data = 'test data'
+        data = b'test data'
 
         storage.write(uri, data)
         Session.rollback()
@@ -78,7 +81,7 @@ class StorageTest(BaseTestCase):
     def test_setting_data_to_none_deletes_file(self):
 
         uri = 'test://test_setting_data_to_none_deletes_file'
-        data = 'test data'
+        data = b'test data'
 
         storage.write(uri, data)
         transaction.commit()
@@ -96,7 +99,7 @@ class StorageTest(BaseTestCase):
     def test_list_uncommitted_file_shows_up_as_result(self):
 
         uri = 'test://test_list_uncommitted_file_shows_up_as_result'
-        data = 'test data'
+        data = b'test data'
 
         storage.write(uri, data)
 
@@ -107,7 +110,7 @@ class StorageTest(BaseTestCase):
     def test_list_committed_file_shows_up_as_result(self):
 
         uri = 'test://test_list_committed_file_shows_up_as_result'
-        data = 'test data'
+        data = b'test data'
 
         storage.write(uri, data)
         transaction.commit()
@@ -134,3 +137,374 @@ class StorageTest(BaseTestCase):
         self.assertNotIn('deleted_uncommited', storage.list('test://list/'))
 
 
+
+    def test_write_behind_read_serves_data_until_it_landed(self):
+
+        storage.enable_write_behind(os.path.join(self.test_storage_path, '.journal'))
+        uri = 'test://write_behind/landed'
+        data = b'test data'
+
+        storage.write(uri, data)
+        transaction.commit()
+
+        self.assertEqual(storage.read(uri), data)
+        storage.flush()
+        self.assertEqual(self._get_from_filesystem(uri), data)
+
+
+    def test_write_behind_replays_journal_on_start(self):
+
+        from storagealchemy.journal import Journal
+        journal_path = os.path.join(self.test_storage_path, '.journal')
+        uri = 'test://write_behind/replayed'
+
+        journal = Journal(journal_path)
+        journal.append([(uri, 'write', b'test data')])
+        journal.close()
+
+        storage.enable_write_behind(journal_path)
+
+        self.assertEqual(self._get_from_filesystem(uri), b'test data')
+        self.assertEqual([], Journal(journal_path).pending())
+
+
+    def test_commit_durability_syncs_files_once_per_commit(self):
+
+        handler = FilesystemHandler(self.test_storage_path, uid=self.test_uid, gid=self.test_gid, durability='commit')
+        storage.add_handler('synced', handler)
+
+        storage.write('synced://durability/a', 'a')
+        storage.write('synced://durability/b', 'b')
+        transaction.commit()
+
+        self.assertEqual(set(), handler._unsynced_files)
+        self.assertEqual(set(), handler._unsynced_dirs)
+        self.assertEqual(self._get_from_filesystem('test://durability/b'), b'b')
+
+
+    def test_commit_durability_fsyncs_files_before_directories(self):
+
+        handler = FilesystemHandler(self.test_storage_path, uid=self.test_uid, gid=self.test_gid, durability='commit')
+        storage.add_handler('synced', handler)
+        directory = os.path.join(self.test_storage_path, 'durability')
+
+        storage.write('synced://durability/a', 'a')
+        storage.write('synced://durability/b', 'b')
+        with mock.patch('storagealchemy.handler.fsync_path') as fsync_path:
+            transaction.commit()
+
+        synced = [call[0][0] for call in fsync_path.call_args_list]
+        self.assertEqual(
+            [ os.path.join(directory, 'a')
+            , os.path.join(directory, 'b')
+            ], sorted(synced[:2]))
+        self.assertEqual([self.test_storage_path, directory], sorted(synced[2:]))
+
+
+    def test_per_file_durability_fsyncs_before_returning(self):
+
+        handler = FilesystemHandler(self.test_storage_path, uid=self.test_uid, gid=self.test_gid, durability='per-file')
+        unsynced = FilesystemHandler(self.test_storage_path, uid=self.test_uid, gid=self.test_gid)
+
+        with mock.patch('os.fsync') as fsync:
+            unsynced.write('durability/none', b'test data')
+            self.assertEqual(0, fsync.call_count)
+            handler.write('durability/a', b'test data')
+            # the file and its directory
+            self.assertEqual(2, fsync.call_count)
+
+
+    def test_read_range_of_committed_file(self):
+
+        uri = 'test://test_read_range_of_committed_file'
+
+        storage.write(uri, b'test data')
+        transaction.commit()
+
+        self.assertEqual(storage.read(uri, offset=5, length=2), b'da')
+        self.assertEqual(storage.read(uri, offset=5), b'data')
+
+
+    def test_stat_reflects_pending_tasks(self):
+
+        uri = 'test://test_stat_reflects_pending_tasks'
+
+        storage.write(uri, b'test data')
+        self.assertTrue(storage.exists(uri))
+        self.assertEqual(storage.size(uri), 9)
+        transaction.commit()
+        self.assertEqual(storage.size(uri), 9)
+
+        storage.delete(uri)
+        self.assertFalse(storage.exists(uri))
+        self.assertIsNone(storage.stat(uri))
+
+
+    def test_buffer_protocol_data_is_stored_verbatim(self):
+
+        uri = 'test://test_buffer_protocol_data_is_stored_verbatim'
+        data = bytearray(b'\x00\xff\r\n\x1a')
+
+        storage.write(uri, memoryview(data))
+        self.assertEqual(storage.size(uri), 5)
+        transaction.commit()
+
+        self.assertEqual(storage.read(uri), bytes(data))
+        self.assertEqual(self._get_from_filesystem(uri), bytes(data))
+
+
+    def test_pending_read_returns_bytes_copy(self):
+
+        uri = 'test://test_pending_read_returns_bytes_copy'
+        data = bytearray(b'test data')
+
+        storage.write(uri, data)
+        result = storage.read(uri)
+        data[0:4] = b'best'
+
+        self.assertIsInstance(result, bytes)
+        self.assertEqual(result, b'test data')
+
+        storage.write(uri, u'test data')
+        self.assertEqual(storage.read(uri), b'test data')
+
+
+    def test_copy_is_applied_on_commit(self):
+
+        storage.write('test://copy/src', b'test data')
+        transaction.commit()
+
+        storage.copy('test://copy/src', 'test://copy/dst')
+        self.assertEqual(storage.read('test://copy/dst'), b'test data')
+        self.assertIsNone(self._get_from_filesystem('test://copy/dst'))
+        transaction.commit()
+
+        storage.write('test://copy/src', b'changed')
+        transaction.commit()
+        self.assertEqual(self._get_from_filesystem('test://copy/dst'), b'test data')
+
+
+    def test_moves_can_swap_files(self):
+
+        storage.write('test://move/a', b'a')
+        storage.write('test://move/b', b'b')
+        transaction.commit()
+
+        storage.move('test://move/a', 'test://move/tmp')
+        storage.move('test://move/b', 'test://move/a')
+        storage.move('test://move/tmp', 'test://move/b')
+        transaction.commit()
+
+        self.assertEqual(self._get_from_filesystem('test://move/a'), b'b')
+        self.assertEqual(self._get_from_filesystem('test://move/b'), b'a')
+        self.assertNotIn('tmp', storage.list('test://move/'))
+
+
+    def test_pack_handler_commits_and_reloads_index(self):
+
+        from storagealchemy.handler import PackHandler
+        pack_path = os.path.join(self.test_storage_path, 'pack')
+        pack = PackHandler(pack_path)
+        storage.add_handler('pack', pack)
+
+        storage.write('pack://a/b', b'test data')
+        storage.write('pack://a/c', b'other data')
+        transaction.commit()
+        storage.delete('pack://a/c')
+        transaction.commit()
+
+        self.assertRaises(StorageError, PackHandler, pack_path)
+        pack.close()
+        handler = PackHandler(pack_path)
+        self.assertEqual(handler.read('a/b'), b'test data')
+        self.assertEqual(handler.read('a/b', offset=5, length=2), b'da')
+        self.assertFalse(handler.has('a/c'))
+
+
+    def test_pack_handler_compaction_keeps_live_objects(self):
+
+        from storagealchemy.handler import PackHandler
+        handler = PackHandler(os.path.join(self.test_storage_path, 'pack'), segment_size=16)
+
+        for i in range(8):
+            handler.write('%s' % i, b'0123456789')
+        handler.copy('0', 'copy')
+        for i in range(1, 8):
+            handler.delete('%s' % i)
+        handler.flush()
+
+        self.assertTrue(handler.compact() > 0)
+        self.assertEqual(handler.read('0'), b'0123456789')
+        self.assertEqual(handler.read('copy'), b'0123456789')
+        self.assertEqual(['0', 'copy'], sorted(handler.list('')))
+
+
+    def test_conditional_write_with_current_version_succeeds(self):
+
+        uri = 'test://test_conditional_write_with_current_version_succeeds'
+
+        storage.write(uri, b'test data')
+        transaction.commit()
+        data, version = storage.read(uri, with_version=True)
+
+        storage.write(uri, b'changed', if_match=version)
+        transaction.commit()
+
+        self.assertEqual(self._get_from_filesystem(uri), b'changed')
+
+
+    def test_conditional_write_with_stale_version_conflicts(self):
+
+        uri = 'test://test_conditional_write_with_stale_version_conflicts'
+
+        storage.write(uri, b'test data')
+        transaction.commit()
+        data, version = storage.read(uri, with_version=True)
+
+        storage.write(uri, b'concurrent change')
+        transaction.commit()
+
+        storage.write(uri, b'lost update', if_match=version)
+        self.assertRaises(VersionConflict, transaction.commit)
+        transaction.abort()
+
+        self.assertEqual(self._get_from_filesystem(uri), b'concurrent change')
+
+
+    def test_orphan_scan_reports_orphans_and_dangling_references(self):
+
+        from storagealchemy import orphans
+
+        storage.write('test://orphans/referenced', b'test data')
+        storage.write('test://orphans/orphaned', b'test data')
+        Session.add(TestFile(foo='test://orphans/referenced'))
+        Session.add(TestFile(foo='test://orphans/dangling'))
+        transaction.commit()
+
+        handler = FilesystemHandler(self.test_storage_path, uid=self.test_uid, gid=self.test_gid)
+        result = list(orphans.scan(handler, TestFile.foo, 'test', session=Session, chunk_size=1))
+
+        self.assertEqual(
+            [ (orphans.DANGLING, 'test://orphans/dangling')
+            , (orphans.ORPHAN, 'test://orphans/orphaned')
+            ], result)
+
+
+    def test_orphan_scan_below_path_skips_sibling_directories(self):
+
+        from storagealchemy import orphans
+
+        storage.write('test://orphans/referenced', b'test data')
+        storage.write('test://orphans_sibling/referenced', b'test data')
+        Session.add(TestFile(foo='test://orphans/referenced'))
+        Session.add(TestFile(foo='test://orphans_sibling/referenced'))
+        transaction.commit()
+
+        handler = FilesystemHandler(self.test_storage_path, uid=self.test_uid, gid=self.test_gid)
+        result = list(orphans.scan(handler, TestFile.foo, 'test', session=Session, path='orphans'))
+
+        self.assertEqual([], result)
+
+
+    def test_replicated_handler_mirrors_commits(self):
+
+        from storagealchemy.handler import ReplicatedHandler
+        replicas = \
+            [ FilesystemHandler(os.path.join(self.test_storage_path, name), uid=self.test_uid, gid=self.test_gid)
+              for name in ('a', 'b', 'c')
+            ]
+        handler = ReplicatedHandler(replicas, write_quorum=3)
+        storage.add_handler('mirror', handler)
+
+        storage.write('mirror://replicated', b'test data')
+        transaction.commit()
+
+        for name in ('a', 'b', 'c'):
+            self.assertEqual(self._get_from_filesystem('test://%s/replicated' % name), b'test data')
+        self.assertEqual(storage.read('mirror://replicated'), b'test data')
+
+
+    def _replicas(self):
+        return \
+            [ FilesystemHandler(os.path.join(self.test_storage_path, name), uid=self.test_uid, gid=self.test_gid)
+              for name in ('a', 'b', 'c')
+            ]
+
+
+    def test_replicated_write_fails_without_quorum(self):
+
+        from storagealchemy.handler import ReplicatedHandler
+        a, b, c = replicas = self._replicas()
+        handler = ReplicatedHandler(replicas, repair_interval=1000)
+
+        with mock.patch.object(b, 'write', side_effect=IOError('down')), \
+             mock.patch.object(c, 'write', side_effect=IOError('down')):
+            self.assertRaises(StorageError, handler.write, 'replicated', b'test data')
+
+
+    def test_replicated_handler_repairs_replicas_that_missed_writes(self):
+
+        import time
+        from storagealchemy.handler import ReplicatedHandler
+        a, b, c = replicas = self._replicas()
+        handler = ReplicatedHandler(replicas, repair_interval=1000)
+
+        with mock.patch.object(c, 'write', side_effect=IOError('down')):
+            handler.write('replicated', b'test data')
+            time.sleep(0.1)
+
+        for attempt in range(50):
+            if handler.repair() == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(handler.repair(), 0)
+        for name in ('a', 'b', 'c'):
+            self.assertEqual(self._get_from_filesystem('test://%s/replicated' % name), b'test data')
+
+
+    def test_replicated_read_is_hedged(self):
+
+        import time
+        from storagealchemy.handler import ReplicatedHandler
+        a, b, c = replicas = self._replicas()
+        handler = ReplicatedHandler(replicas, write_quorum=3, hedge_after=0.01, repair_interval=1000)
+        handler.write('replicated', b'test data')
+        # a is asked first
+        handler._latency[0] = 0.0
+        read = a.read
+        def slow_read(*args, **kwargs):
+            time.sleep(1)
+            return read(*args, **kwargs)
+
+        with mock.patch.object(a, 'read', side_effect=slow_read):
+            start = time.time()
+            self.assertEqual(handler.read('replicated'), b'test data')
+            self.assertTrue(time.time() - start < 0.4)
+
+
+    def test_pipeline_encodes_on_commit_and_decodes_on_read(self):
+
+        import zlib
+        from storagealchemy.transform import Pipeline, Compress, Checksum
+        pipeline = Pipeline([Compress(), Checksum()], min_parallel_size=1)
+        handler = FilesystemHandler(self.test_storage_path, uid=self.test_uid, gid=self.test_gid)
+        storage.add_handler('packed', handler, pipeline=pipeline)
+        data = b'test data' * 1000
+
+        storage.write('packed://pipeline/a', data)
+        storage.write('packed://pipeline/b', data)
+        transaction.commit()
+
+        self.assertEqual(storage.read('packed://pipeline/a'), data)
+        self.assertEqual(storage.size('packed://pipeline/a'), len(data))
+        self.assertEqual(storage.read('packed://pipeline/b', offset=4, length=5), b' data')
+        stored = self._get_from_filesystem('test://pipeline/a')
+        # a sha256 digest and the decoded size follow the compressed data
+        self.assertEqual(zlib.decompress(stored[:-40]), data)
+        self.assertEqual(int.from_bytes(stored[-8:], 'big'), len(data))
+
+
+    def test_writing_a_stream_raises(self):
+
+        self.assertRaises(StorageError, storage.write, 'test://stream', iter([b'test data']))
+